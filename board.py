@@ -1,4 +1,5 @@
 import numpy as np
+from functools import lru_cache
 import random
 
 def test():
@@ -26,6 +27,14 @@ def validCoordinates(i, j, size=19):
 	if i < 0 or j < 0: return False
 	return True
 
+@lru_cache(maxsize=None)
+def emptyHeat(size=19):
+	"""Return an empty heat map. It is read-only, as it is shared by all the
+	boards having no heat."""
+	heat = np.zeros(shape=(size, size))
+	heat.flags.writeable = False
+	return heat
+
 def coordToStd(i, j, size=19):
 	"""Convert a move from its coordinates format (i, j) to standard
 	format (e.g C15)"""
@@ -87,12 +96,13 @@ class Board:
 				c = self.stones[i][j]
 				self.key ^= Board.ZOBRIST[c][i][j]
 
-	def copy(self):
-		"""Return a copy of the board"""
+	def copy(self, heat=True):
+		"""Return a copy of the board
+		- heat - if False, the copy gets an empty heat map"""
 		size = self.size
 		cpy = Board(size=size)
 		cpy.stones = np.matrix.copy(self.stones)
-		cpy.heat = np.matrix.copy(self.heat)
+		cpy.heat = np.matrix.copy(self.heat) if heat else emptyHeat(size)
 		cpy.key = self.key
 		return cpy
 
@@ -157,6 +167,24 @@ class Board:
 		self.key ^= Board.ZOBRITSTURN[oldpla] ^ Board.ZOBRITSTURN[pla] ^\
 			Board.ZOBRITSTURN[self.turn]
 
+	def playVariation(self, moves, pla):
+		"""Play a variation on a copy of the board, with captures. Return the
+		stones at its end, and the number (from 1) of the move that put each
+		remaining stone of the variation, as a dict {(i, j): number}. The
+		variation stops at its first illegal move.
+		- moves - list of coordinates (i, j), played alternately
+		- pla - player of the first move"""
+		cpy = self.copy(heat=False)
+		numbers = {}
+		for n, (i, j) in enumerate(moves):
+			if not cpy.isLegal(i, j, pla): break
+			cpy.playStone(i, j, pla)
+			numbers[(i, j)] = n + 1
+			pla = Board.getOpponent(pla)
+		numbers = {(i, j): n for (i, j), n in numbers.items()
+			if cpy.stones[i][j] != Board.EMPTY}
+		return cpy.stones, numbers
+
 	def captured(self, i, j, pla):
 		"""Return the list of captured chains by move i, j"""
 		adv = Board.getOpponent(pla)
@@ -277,10 +305,10 @@ class Board:
 	def loadHeatFromArray(self, array):
 		"""Load heats from a numpy array"""
 		size = self.size
-		for row in range(size):
-			for col in range(size):
-				self.heat[row][col] = - array[col * size + row]
-				# FIXME -1 * . is articial
+		# A new array is made, as heat arrays may be shared between boards
+		# FIXME -1 * . is articial
+		array = - np.asarray(array, dtype=float)
+		self.heat = array.reshape(size, size).T.copy()
 		self.mergeHeat()
 
 	def deadValue(self, i, j):
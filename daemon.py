@@ -0,0 +1,286 @@
+import os
+import socket
+import socketserver
+import subprocess
+from collections import OrderedDict
+from threading import Thread, Lock
+
+# Path of the Unix socket the daemon listens on
+SOCKET = "/tmp/katago-visualizer.sock"
+# Number of KataGo processes owned by the daemon
+ENGINES = 1
+# Lines sent to a client when it connects - KataGo prints 3 lines at launch
+GREETING = ["KataGo Visualizer daemon", "Serving analyses", "Ready"]
+# Line sent to a client whose engine was taken by another client. It is not
+# a GTP answer: the client handles it apart (see katago.treatOutput).
+STOPPED = "stopped"
+# Number of positions whose last analysis is cached
+CACHE = 1024
+
+class Engine:
+
+	"""A KataGo process owned by the daemon.
+
+	The engine analyses one position at a time and publishes its analysis
+	lines to the clients subscribed to that position. The position is a
+	tuple (boardsize, komi, moves), moves being GTP 'play' commands. The
+	position set up on KataGo is kept after the analysis stops, so that
+	analysing it again reuses KataGo's search tree."""
+
+	def __init__(self, cmd, daemon):
+		self.cmd = cmd
+		self.daemon = daemon
+		self.lock = Lock()
+		self.position = None # position analysed, None if stopped
+		self.board = None # position set up on KataGo
+		self.analysisCmd = None
+		self.subscribers = set()
+		# Number of GTP answers still expected. Analysis lines are published
+		# only once KataGo answered all the commands sent to it, so that
+		# late lines of a previous position are dropped.
+		self.pending = 0
+		self._spawn()
+
+	def _spawn(self):
+		"""Start KataGo and the thread reading its output"""
+		self.pid = subprocess.Popen(self.cmd.split(), stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1)
+		self.pending = 0
+		self.board = None
+		self.thread = Thread(target=self._read, args=(self.pid.stdout,))
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _read(self, out):
+		"""Read KataGo's output until it dies, then respawn it"""
+		for line in iter(out.readline, b''):
+			if line.startswith(b"=") or line.startswith(b"?"):
+				with self.lock:
+					if self.pending > 0: self.pending -= 1
+			elif line.startswith(b"info") and self.pending == 0:
+				self.daemon.publish(self, line)
+		out.close()
+
+		print("Engine exited (code {}), restarting".format(self.pid.wait()))
+		with self.daemon.lock:
+			self._spawn()
+			if self.subscribers:
+				self.analyse(self.position, self.analysisCmd)
+
+	def _write(self, cmds):
+		"""Write a list of GTP commands in one write"""
+		with self.lock:
+			self.pending += len(cmds)
+			txt = "".join(cmd + "\n" for cmd in cmds)
+			try:
+				self.pid.stdin.write(txt.encode())
+				self.pid.stdin.flush()
+			except OSError:
+				print("Failed to write to engine")
+
+	def analyse(self, position, analysisCmd):
+		"""Set up a position, unless it is already, and start analysing it"""
+		self.position = position
+		self.analysisCmd = analysisCmd
+		cmds = []
+		if position != self.board:
+			boardsize, komi, moves = position
+			cmds = ["clear_board", "boardsize {}".format(boardsize),
+				"komi {}".format(komi)] + list(moves)
+			self.board = position
+		self._write(cmds + [analysisCmd])
+
+	def stop(self):
+		"""Stop the running analysis"""
+		self.position = None
+		self._write(["stop"])
+
+class Daemon:
+
+	"""Pool of engines and analysis cache shared by several visualizers.
+
+	Identical positions asked by different clients are analysed once, and
+	the last analysis of the CACHE last positions is kept so that a client
+	coming back to a position gets it instantly."""
+
+	def __init__(self, cmd, engines=ENGINES):
+		self.lock = Lock()
+		self.cache = OrderedDict()
+		self.engines = [Engine(cmd, self) for i in range(engines)]
+
+	def publish(self, engine, line):
+		"""Send an analysis line to the subscribers of an engine"""
+		with self.lock:
+			self.cache[engine.position] = line
+			self.cache.move_to_end(engine.position)
+			if len(self.cache) > CACHE: self.cache.popitem(last=False)
+			for client in list(engine.subscribers):
+				client.send(line)
+
+	def subscribe(self, client, position, analysisCmd):
+		"""Subscribe a client to the analysis of a position.
+
+		If the client already follows this position, it keeps its engine,
+		which is only given the new analysis command. If no engine analyses
+		this position, take an idle engine, preferably one already set up on
+		it - or the engine with the fewest subscribers, whose clients are
+		then stopped. They are told so by a STOPPED line."""
+		with self.lock:
+			if position in self.cache:
+				self.cache.move_to_end(position)
+				client.send(self.cache[position])
+			engine = client.engine
+			if engine and engine.position == position:
+				if analysisCmd != engine.analysisCmd:
+					engine.analyse(position, analysisCmd)
+				return None
+			self._unsubscribe(client)
+
+			for engine in self.engines:
+				if engine.position == position:
+					engine.subscribers.add(client)
+					client.engine = engine
+					return None
+
+			engine = min(self.engines, key=lambda e: (len(e.subscribers),
+				e.board != position))
+			for other in engine.subscribers:
+				other.engine = None
+				other.send((STOPPED + "\n").encode())
+				other.send(b"\n") # end of the analysis
+			engine.subscribers = set([client])
+			client.engine = engine
+			engine.analyse(position, analysisCmd)
+
+	def unsubscribe(self, client):
+		"""Unsubscribe a client from its engine. Stop the engine if nobody
+		is listening anymore."""
+		with self.lock:
+			self._unsubscribe(client)
+
+	def _unsubscribe(self, client):
+		"""Same as unsubscribe(), the daemon being already locked"""
+		engine = client.engine
+		if not engine: return None
+		client.engine = None
+		engine.subscribers.discard(client)
+		if not engine.subscribers: engine.stop()
+
+	def clearCache(self):
+		"""Forget all analyses"""
+		with self.lock:
+			self.cache = OrderedDict()
+
+class Client(socketserver.StreamRequestHandler):
+
+	"""A visualizer connected to the daemon.
+
+	The client talks GTP, as it would to KataGo. The board state is kept
+	here and only sent to an engine when an analysis is asked."""
+
+	def setup(self):
+		super().setup()
+		self.lock = Lock()
+		self.engine = None
+		self.boardsize = 19
+		self.komi = 7.5
+		self.moves = []
+
+	def send(self, data):
+		"""Send raw bytes to the client"""
+		with self.lock:
+			try:
+				self.wfile.write(data)
+				self.wfile.flush()
+			except OSError:
+				pass
+
+	def answer(self, txt=""):
+		"""Send a GTP answer"""
+		self.send("= {}\n\n".format(txt).encode())
+
+	def handle(self):
+		daemon = self.server.daemon
+		for txt in GREETING:
+			self.send((txt + "\n").encode())
+
+		for line in iter(self.rfile.readline, b''):
+			tokens = line.decode().split()
+			if tokens == []: continue
+			cmd = tokens[0]
+			if cmd == "boardsize":
+				self.boardsize = int(tokens[1])
+				self.moves = []
+				self.answer()
+			elif cmd == "komi":
+				self.komi = float(tokens[1])
+				self.answer()
+			elif cmd == "play":
+				self.moves.append(" ".join(tokens))
+				self.answer()
+			elif cmd == "undo":
+				if self.moves != []: self.moves.pop()
+				self.answer()
+			elif cmd == "clear_board":
+				self.moves = []
+				self.answer()
+			elif cmd == "clear-cache":
+				daemon.clearCache()
+				self.answer()
+			elif cmd == "stop":
+				if self.engine:
+					daemon.unsubscribe(self)
+					self.send(b"\n") # end of the analysis
+				self.answer()
+			elif cmd == "kata-analyze":
+				if self.engine: self.send(b"\n") # end of the previous analysis
+				self.send(b"=\n")
+				position = self.boardsize, self.komi, tuple(self.moves)
+				daemon.subscribe(self, position, " ".join(tokens))
+			elif cmd == "quit":
+				self.answer()
+				break
+			else:
+				self.send("? {} is not served by the daemon\n\n".format(
+					cmd).encode())
+
+		daemon.unsubscribe(self)
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+class Connection:
+
+	"""Connection to the daemon. It has the interface of the Popen object
+	katago.KataGo uses, so that a KataGo object can talk to the daemon as it
+	would to a KataGo subprocess."""
+
+	def __init__(self, path=SOCKET):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.connect(path)
+		self.stdin = self.sock.makefile("wb")
+		self.stdout = self.sock.makefile("rb")
+
+	def poll(self):
+		"""The daemon's exit code is unknown"""
+		return None
+
+	def kill(self):
+		"""Cut the connection - the reader thread will then reconnect"""
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+
+	def wait(self):
+		self.sock.close()
+		return None
+
+def serve(cmd, path=SOCKET, engines=ENGINES):
+	"""Run the daemon. Never returns.
+	- cmd - command line launching KataGo"""
+	if os.path.exists(path): os.remove(path)
+	server = Server(path, Client)
+	server.daemon = Daemon(cmd, engines)
+	print("Daemon listening on {} with {} engine(s)".format(path, engines))
+	server.serve_forever()
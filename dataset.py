@@ -0,0 +1,179 @@
+import os
+import sys
+import numpy as np
+
+from infos import Infos, INFO_DTYPE
+from seqfile import SeqFile, encodeSeq, encodeInfos
+
+# Paths ending with this extension are binary datasets, other paths are text
+# sequence files (see seqfile.SeqFile)
+EXT = ".dataset"
+
+# One entry per position. Starts index the other columns.
+INDEX_DTYPE = np.dtype([("moveStart", "u8"), ("moveCount", "u4"),
+	("infoStart", "u8"), ("infoCount", "u4"), ("pvStart", "u8"),
+	("heatStart", "u8"), ("analysed", "u1")])
+
+# Columns of a dataset, each stored raw in its own file. Moves are encoded
+# as 'pla << 9 | i * 19 + j', PV moves as 'i * 19 + j'.
+COLUMNS = {
+	"index": INDEX_DTYPE,
+	"moves": np.dtype("u2"),
+	"infos": INFO_DTYPE,
+	"pvlens": np.dtype("u2"),
+	"pvs": np.dtype("u2"),
+	"ownership": np.dtype("f2"),
+}
+
+def isDataset(path):
+	"""Return True if 'path' names a binary dataset"""
+	return path.rstrip("/").endswith(EXT)
+
+def openSequences(path):
+	"""Open a dataset or a text sequence file, according to its path"""
+	return Dataset(path) if isDataset(path) else SeqFile(path)
+
+class DatasetWriter:
+
+	"""Append positions to a dataset, creating it if needed.
+
+	Columns are written first and the index last, so that an interrupted
+	write leaves the dataset readable."""
+
+	def __init__(self, path):
+		os.makedirs(path, exist_ok=True)
+		self.files = {name: open(os.path.join(path, name), "ab")
+			for name in COLUMNS}
+		self.counts = {name: self.files[name].tell() // dtype.itemsize
+			for name, dtype in COLUMNS.items()}
+
+	def _append(self, name, array):
+		"""Append an array to a column and return its start"""
+		start = self.counts[name]
+		array = np.ascontiguousarray(array, dtype=COLUMNS[name])
+		self.files[name].write(array.tobytes())
+		self.counts[name] += array.size
+		return start
+
+	def write(self, moves, analyse=None):
+		"""Append a position.
+		- moves - list of moves (pla, i, j) from the root
+		- analyse - as returned by katago.parseLine(), or None"""
+		entry = np.zeros(1, dtype=INDEX_DTYPE)[0]
+		coded = [(pla << 9) | (i * 19 + j) for pla, i, j in moves]
+		entry["moveStart"] = self._append("moves", coded)
+		entry["moveCount"] = len(coded)
+		infos, heatInfos = analyse if analyse != None else (Infos(), None)
+		if not isinstance(infos, Infos): infos = Infos.fromList(infos)
+		entry["infoStart"] = self._append("infos", infos.rows)
+		entry["infoCount"] = len(infos)
+		self._append("pvlens", np.diff(infos.offsets))
+		entry["pvStart"] = self._append("pvs", infos.moves)
+		if analyse != None:
+			entry["analysed"] = 1
+			entry["heatStart"] = self._append("ownership", heatInfos) // 361
+		for name in COLUMNS:
+			if name != "index": self.files[name].flush()
+		self._append("index", np.array([entry], dtype=INDEX_DTYPE))
+		self.files["index"].flush()
+
+	def close(self):
+		for f in self.files.values(): f.close()
+
+def append(path, moves, analyse=None):
+	"""Append a position to the dataset at 'path' (see DatasetWriter.write)"""
+	writer = DatasetWriter(path)
+	writer.write(moves, analyse)
+	writer.close()
+
+class Dataset:
+
+	"""Binary dataset of positions with their analysis.
+
+	Each column (see COLUMNS) is a raw file mapped in memory, so that opening
+	a dataset reads nothing and a position is decoded by slicing arrays,
+	without parsing text. The ownership is stored as float16 and the infos
+	as infos.Infos arrays. It has the interface of seqfile.SeqFile."""
+
+	def __init__(self, path):
+		if not os.path.isdir(path):
+			raise OSError("{} is not a dataset".format(path))
+		self.path = path
+		self.columns = {name: self._map(name, dtype)
+			for name, dtype in COLUMNS.items()}
+		self.columns["ownership"] = self.columns["ownership"].reshape(-1, 361)
+
+	def _map(self, name, dtype):
+		"""Map a column in memory"""
+		path = os.path.join(self.path, name)
+		if not os.path.exists(path) or os.path.getsize(path) == 0:
+			return np.zeros(0, dtype=dtype)
+		return np.memmap(path, dtype=dtype, mode="r")
+
+	def __len__(self):
+		return len(self.columns["index"])
+
+	def __getitem__(self, k):
+		"""Return the k-th position as a list of moves (pla, i, j) and its
+		analysis, as returned by katago.parseLine() - or None"""
+		cols = self.columns
+		entry = cols["index"][k]
+		start, count = int(entry["moveStart"]), int(entry["moveCount"])
+		moves = [(m >> 9, *divmod(m & 0x1ff, 19))
+			for m in cols["moves"][start:start+count].tolist()]
+		if not entry["analysed"]: return moves, None
+
+		start, count = int(entry["infoStart"]), int(entry["infoCount"])
+		offsets = np.zeros(count + 1, dtype="uint32")
+		np.cumsum(cols["pvlens"][start:start+count], out=offsets[1:])
+		pvStart = int(entry["pvStart"])
+		infos = Infos(np.array(cols["infos"][start:start+count]),
+			np.array(cols["pvs"][pvStart:pvStart+offsets[-1]]), offsets)
+		heat = cols["ownership"][int(entry["heatStart"])].astype(float)
+		return moves, (infos, heat)
+
+	def prefetch(self, k):
+		"""Positions are decoded by slicing, there is nothing to prefetch"""
+		return None
+
+	def close(self):
+		self.columns = {name: np.zeros(0, dtype=dtype)
+			for name, dtype in COLUMNS.items()}
+
+def convert(src, dst):
+	"""Convert a text sequence file into a dataset, or conversely. The
+	formats are given by the paths (see isDataset). Entries that cannot be
+	decoded are skipped."""
+	seqs = openSequences(src)
+	def decoded():
+		for k in range(len(seqs)):
+			try:
+				yield seqs[k]
+			except Exception as e:
+				print("Failed to decode sequence {} ({})".format(k, e))
+
+	count = 0
+	if isDataset(dst):
+		writer = DatasetWriter(dst)
+		for moves, analyse in decoded():
+			writer.write(moves, analyse)
+			count += 1
+		writer.close()
+	else:
+		with open(dst, "a") as out:
+			for moves, analyse in decoded():
+				txt = encodeSeq(moves) + "@"
+				if analyse != None: txt += encodeInfos(*analyse)
+				print(txt, file=out)
+				count += 1
+	print("Converted {} of {} positions from {} to {}".format(count,
+		len(seqs), src, dst))
+	seqs.close()
+
+if __name__ == "__main__":
+	if len(sys.argv) != 3:
+		print("Usage: python3 dataset.py SOURCE DESTINATION")
+		print("Paths ending with {} are binary datasets, others are text."
+			.format(EXT))
+		raise SystemExit(1)
+	convert(sys.argv[1], sys.argv[2])
@@ -0,0 +1,78 @@
+import numpy as np
+
+def decimate(values, width, top, bottom, height):
+	"""Decimate a series to one vertical span per pixel column: the extremes
+	of the series over the column, the series being linearly interpolated
+	between its points. Return an int array of (top, bottom) pixel rows, of
+	shape (width, 2).
+	- values - the series, spread over the whole width
+	- top, bottom - the values drawn at the top and bottom of the graph
+	- height - height of the graph, in pixels"""
+	values = np.asarray(values, dtype=float)
+	ys = height * (top - values) / (top - bottom)
+	xs = np.arange(len(values)) * (width / (len(values) - 1))
+	edges = np.interp(np.arange(width + 1), xs, ys)
+	upper = np.minimum(edges[:-1], edges[1:])
+	lower = np.maximum(edges[:-1], edges[1:])
+	columns = np.minimum(xs.astype(int), width - 1)
+	np.minimum.at(upper, columns, ys)
+	np.maximum.at(lower, columns, ys)
+	return np.stack([upper, lower], axis=1).astype(int)
+
+class Graph:
+
+	"""Pixel columns of the score diagram, and its optional overlays.
+
+	Every series is decimated (see decimate()) so that drawing the diagram
+	costs the same whatever the number of moves. Two graphs are compared
+	column by column, so that only the columns that changed are drawn again
+	(see render.updateGraph)."""
+
+	def __init__(self, width, height, scores, stdevs=None, winrates=None):
+		"""
+		- width, height - size of the diagram, in pixels
+		- scores - Black's scores, from root to current
+		- stdevs - standard deviations of the scores, drawn as a band around
+		  them if set
+		- winrates - Black's winrates, drawn from 0 (bottom) to 1 (top) if
+		  set"""
+		self.width = width
+		self.height = height
+		bottom = min(-5, min(scores)) - 1
+		top = max(5, max(scores)) + 1
+		row = lambda v: int(height * (top - v) / (top - bottom))
+
+		# Rows of the zero line and of the guides every 5 points
+		self.middle = row(0)
+		self.guides = tuple(row(five)
+			for five in range(5 * int(bottom // 5), int(top) + 1, 5))
+
+		# Spans of the area between the zero line and the scores
+		area = decimate(scores, width, top, bottom, height)
+		area[:, 0] = np.minimum(area[:, 0], self.middle)
+		area[:, 1] = np.maximum(area[:, 1], self.middle)
+		self.series = {"area": area}
+		if stdevs is not None:
+			self.series["stdevup"] = decimate(np.add(scores, stdevs), width,
+				top, bottom, height)
+			self.series["stdevdown"] = decimate(np.subtract(scores, stdevs),
+				width, top, bottom, height)
+		if winrates is not None:
+			self.series["winrate"] = decimate(winrates, width, 1, 0, height)
+
+	def dirty(self, prev):
+		"""Return the mask of the columns that differ from a previous graph,
+		or of all columns if prev is None or has another scale"""
+		if prev is None or (self.width, self.height, self.middle, self.guides,
+			sorted(self.series)) != (prev.width, prev.height, prev.middle,
+			prev.guides, sorted(prev.series)):
+			return np.ones(self.width, dtype=bool)
+		mask = np.zeros(self.width, dtype=bool)
+		for name, spans in self.series.items():
+			mask |= np.any(spans != prev.series[name], axis=1)
+		return mask
+
+	def __eq__(self, other):
+		return isinstance(other, Graph) and not self.dirty(other).any()
+
+	__hash__ = None
@@ -1,8 +1,15 @@
+from array import array
+
 from board import *
-from katago import parseLine
+from infos import Infos
+from store import AnalysisStore
+from seqfile import decodeSeq, encodeSeq, encodeInfos
+from dataset import openSequences
 
-TTIME = 100
+TTIME = None # let KataGo adapt its reporting interval
 LVLMUL = 100
+FORGET_BARRIER = 0.5 # losses smaller than this (in points) are ignored
+LVL_EWMA = 0.2 # weight of the last loss in the moving average
 
 
 def cumulate(a):
@@ -13,6 +20,340 @@ def cumulate(a):
 		b[i] = (i*b[i-1] + a[i])/(i+1)
 	return b
 
+def backfill(values, default=0):
+	"""Replace missing values (NaN or 0) of an array by the next present 
+	value, and by 'default' at the end of the array."""
+	n = len(values)
+	present = ~np.isnan(values) & (values != 0)
+	nextidx = np.where(present, np.arange(n), n)
+	nextidx = np.minimum.accumulate(nextidx[::-1])[::-1]
+	res = np.append(values, default)[nextidx]
+	res.flags.writeable = False
+	return res
+
+def totalVisits(pv):
+	"""Return the number of visits of an analysis"""
+	if isinstance(pv, Infos): return pv.totalVisits()
+	return sum(info[0] for info in pv)
+
+def encodeMove(move):
+	"""Encode a move (pla, i, j) into an integer. None is encoded as -1."""
+	if move == None: return -1
+	pla, i, j = move
+	return (pla << 16) | ((i + 1) << 8) | (j + 1)
+
+def decodeMove(code):
+	"""Decode a move encoded by encodeMove()"""
+	if code < 0: return None
+	return code >> 16, ((code >> 8) & 0xff) - 1, (code & 0xff) - 1
+
+class Line:
+
+	"""Cache of the analysis values along the line from the root to the 
+	current node: score of Black, score standard deviation and winrate of
+	Black. Values are NaN for nodes that were not analysed.
+
+	The line is synced lazily with the current node, so going forward or 
+	backward only costs the nodes added to the line. When an analysis
+	changes, only the entries of the nodes using its slot are recomputed.
+	Filled sequences (see backfill) are cached until the line changes.
+
+	The line also keeps running statistics of the normalized losses of each
+	player (see Node.getLossList): count, sum, sum of squares and moving 
+	average, cumulated up to each move. Only the statistics after the first 
+	changed loss are recomputed."""
+
+	def __init__(self, tree):
+		self.tree = tree
+		self.ids = []
+		self.size = 0
+		self.slots = np.zeros(0, dtype="int32")
+		self.score = np.zeros(0)
+		self.stdev = np.zeros(0)
+		self.winrate = np.zeros(0)
+		self.filled = {}
+		# lstats[:, i] - statistics of the losses of index <= i having the
+		# same parity as i. Valid for i < lossValid.
+		self.lstats = np.zeros((4, 0))
+		self.lossValid = 0
+		self.lossPla = None
+
+	def _reserve(self, size):
+		"""Make sure arrays can hold 'size' entries"""
+		if size <= len(self.score): return None
+		cap = max(2 * len(self.score), size, 64)
+		for name in ("slots", "score", "stdev", "winrate"):
+			old = getattr(self, name)
+			new = np.zeros(cap, dtype=old.dtype)
+			new[:len(old)] = old
+			setattr(self, name, new)
+		lstats = np.zeros((4, cap))
+		lstats[:, :self.lstats.shape[1]] = self.lstats
+		self.lstats = lstats
+
+	def _present(self, k):
+		"""Return True if the k-th node of the line has analysis values"""
+		return not (np.isnan(self.score[k]) or self.score[k] == 0 \
+			or np.isnan(self.stdev[k]) or self.stdev[k] == 0)
+
+	def _invalidate(self, k):
+		"""Filled values of the k-th node changed, and so did those of the
+		unanalysed nodes before it. Invalidate the losses using them."""
+		while k > 0 and not self._present(k - 1): k -= 1
+		self.lossValid = min(self.lossValid, max(k - 1, 0))
+
+	def _compute(self, k):
+		"""Compute the values of the k-th node of the line"""
+		node = self.tree.node(self.ids[k])
+		self.slots[k] = self.tree.slots[node.id]
+		score = node.scoreMean()
+		if score == None:
+			self.score[k] = self.stdev[k] = self.winrate[k] = np.nan
+			return None
+		pv = node.pv
+		sign = Board.getSign(node.getTurn(current=False))
+		self.score[k] = score
+		self.stdev[k] = pv["scoreStdev"][0]
+		self.winrate[k] = 0.5 - (pv["winrate"][0] - 0.5) * sign
+
+	def sync(self):
+		"""Make the line go from the root to the current node"""
+		tree = self.tree
+		if self.ids != [] and self.ids[-1] == tree.current: return None
+		if self.ids != [] and self.ids[0] != tree.root: self.ids = []
+
+		# Walk up from the current node until we meet the line
+		pos = {nid: k for k, nid in enumerate(self.ids)}
+		added = []
+		nid = tree.current
+		while nid not in pos:
+			added.append(nid)
+			if nid == tree.root: break
+			nid = tree.parent[nid]
+		keep = pos[nid] + 1 if nid in pos else 0
+		added.reverse()
+
+		self.ids = self.ids[:keep] + added
+		self.size = len(self.ids)
+		self._reserve(self.size)
+		for k in range(keep, self.size):
+			self._compute(k)
+		self.filled = {}
+		self._invalidate(keep)
+
+	def update(self, slot):
+		"""Recompute the entries of the nodes using an analysis slot"""
+		for k in np.nonzero(self.slots[:self.size] == slot)[0]:
+			self._compute(k)
+			self.filled = {}
+			self._invalidate(k)
+
+	def updateNode(self, nid):
+		"""Recompute the entries of a node, if it is in the line"""
+		for k in range(self.size - 1, -1, -1):
+			if self.ids[k] == nid:
+				self._compute(k)
+				self.filled = {}
+				self._invalidate(k)
+				return None
+
+	def reset(self):
+		"""Forget the whole line"""
+		self.ids = []
+		self.size = 0
+		self.filled = {}
+		self.lossValid = 0
+
+	def get(self, name):
+		"""Return a filled sequence (see backfill) from root to current.
+		- name - "score", "stdev", "winrate" or "normalized" for the score
+		  divided by the standard deviation (at least 10)"""
+		self.sync()
+		if name not in self.filled:
+			n = self.size
+			if name == "normalized":
+				values = self.score[:n] / np.maximum(self.stdev[:n], 10)
+			else:
+				values = getattr(self, name)[:n]
+			default = 0.5 if name == "winrate" else 0
+			self.filled[name] = backfill(values, default)
+		return self.filled[name]
+
+	def levelStats(self, pla, turn):
+		"""Return the statistics (count, mean, variance, moving average) of
+		the normalized losses of a player. Empty statistics are (0, None,
+		None, None).
+		- turn - the player to move at the current node"""
+		self.sync()
+		n = self.size - 1 # number of losses
+		# The loss i is attributed to the player to move at node i
+		pla0 = turn if n % 2 == 0 else Board.getOpponent(turn)
+		if pla0 != self.lossPla:
+			self.lossPla = pla0
+			self.lossValid = 0
+
+		if self.lossValid < n:
+			scores, stdev = self.get("score"), self.get("stdev")
+			for i in range(self.lossValid, n):
+				loss = scores[i+1] - scores[i]
+				if abs(loss) < FORGET_BARRIER: loss = 0
+				if stdev[i] != 0: loss /= stdev[i]
+				if (i % 2 == 0) != (pla0 == Board.BLACK): loss = - loss
+				if i < 2:
+					self.lstats[:, i] = 1, loss, loss * loss, loss
+				else:
+					count, total, squares, ewma = self.lstats[:, i-2]
+					self.lstats[:, i] = count + 1, total + loss, \
+						squares + loss * loss, \
+						LVL_EWMA * loss + (1 - LVL_EWMA) * ewma
+			self.lossValid = n
+
+		last = n - 1 if (pla == pla0) == ((n - 1) % 2 == 0) else n - 2
+		if last < 0: return 0, None, None, None
+		count, total, squares, ewma = self.lstats[:, last]
+		mean = total / count
+		return int(count), mean, squares / count - mean * mean, ewma
+
+class Tree:
+
+	"""Arena storing the nodes of a history tree.
+
+	Nodes are integer ids indexing parallel arrays: parent, first child,
+	last child and next sibling ids, the encoded move and the analysis slot.
+	The root and current node are stored once for the whole tree, so that 
+	they are accessed in O(1). Boards are stored in a list, without their 
+	heat, and analyses in a memory-bounded store (see store.AnalysisStore)
+	indexed by slot. Children are also indexed by their
+	parent id and board key in a dictionary, so that finding a child is O(1).
+
+	Analysis slots are shared by transpositions: the position table maps
+	(board key, player to move) to a slot, and nodes reaching the same 
+	position use the same analysis record (pv, heat and raw evaluation).
+	The record keeps the deepest analysis: the live analysis of the current
+	node is kept apart in .live (pv, heat), and only written back once it
+	has more visits. It is forgotten when the current node changes.
+	"""
+
+	NONE = -1
+
+	def __init__(self, katago):
+		self.katago = katago
+		self.parent = array("i")
+		self.firstChild = array("i")
+		self.lastChild = array("i")
+		self.nextSibling = array("i")
+		self.moves = array("i")
+		self.slots = array("i")
+		self.boards = []
+		self.store = AnalysisStore()
+		self.slotRefs = []
+		self.positions = {}
+		self.childIndex = {}
+		self.live = None
+		self.root = self.newNode(Tree.NONE)
+		self.current = self.root
+		self.line = Line(self)
+		self.loadedseq = []
+		self.loadId = 0
+
+	@property
+	def current(self):
+		return self._current
+
+	@current.setter
+	def current(self, nid):
+		old = getattr(self, "_current", None)
+		if nid != old:
+			self.live = None
+			# Only the current board carries the heat of its analysis (see
+			# Node.getCurrentBoard), the store keeps it for the others
+			board = self.boards[old] if old != None else None
+			if board != None: board.heat = emptyHeat(board.size)
+		self._current = nid
+
+	def newNode(self, parent):
+		"""Create a node and append it to the children of 'parent'.
+		If 'parent' is Tree.NONE, the node is its own parent. Return its id."""
+		nid = len(self.parent)
+		self.parent.append(nid if parent == Tree.NONE else parent)
+		self.firstChild.append(Tree.NONE)
+		self.lastChild.append(Tree.NONE)
+		self.nextSibling.append(Tree.NONE)
+		self.moves.append(-1)
+		self.slots.append(self.newSlot())
+		self.boards.append(None)
+
+		if parent != Tree.NONE:
+			if self.lastChild[parent] == Tree.NONE:
+				self.firstChild[parent] = nid
+			else:
+				self.nextSibling[self.lastChild[parent]] = nid
+			self.lastChild[parent] = nid
+		return nid
+
+	def newSlot(self):
+		"""Create an empty analysis record and return its slot"""
+		self.slotRefs.append(1)
+		return len(self.slotRefs) - 1
+
+	def indexPosition(self, nid):
+		"""Register the position of a node in the position table. If the
+		position is already known, the node shares its analysis slot."""
+		move = decodeMove(self.moves[nid])
+		turn = Board.BLACK if move == None else Board.getOpponent(move[0])
+		key = self.boards[nid].key, turn
+		slot = self.slots[nid]
+		shared = self.positions.get(key, slot)
+		if shared == slot:
+			self.positions[key] = slot
+			return None
+		# Keep the deepest analysis in the shared record
+		pv, heat, rawnn = self.store.get(slot)
+		if totalVisits(pv) > totalVisits(self.store.get(shared)[0]):
+			self.store.update(shared, pv=pv, heat=heat)
+		self.slotRefs[slot] -= 1
+		if self.slotRefs[slot] == 0: self.store.discard(slot)
+		self.slotRefs[shared] += 1
+		self.slots[nid] = shared
+		self.line.updateNode(nid)
+
+	def isTransposition(self, nid):
+		"""Return True if the position of a node is reached by other nodes"""
+		return self.slotRefs[self.slots[nid]] > 1
+
+	def touchSlot(self, slot):
+		"""Tell the caches that the analysis of a slot changed"""
+		self.line.update(slot)
+
+	def touchChildren(self, nid):
+		"""Tell the caches that the move of a node changed. The turn of its
+		children, hence their absolute values, may have changed."""
+		for child in self.childIds(nid):
+			self.line.update(self.slots[child])
+
+	def setChildBoard(self, nid, board):
+		"""Set the board of a node and index it among its siblings"""
+		self.boards[nid] = board
+		self.childIndex[(self.parent[nid], board.key)] = nid
+
+	def findChild(self, nid, key):
+		"""Return the id of the child of 'nid' whose board key is 'key', or
+		Tree.NONE if there is no such child"""
+		return self.childIndex.get((nid, key), Tree.NONE)
+
+	def childIds(self, nid):
+		"""Return the list of the children ids of a node, in order"""
+		ids = []
+		child = self.firstChild[nid]
+		while child != Tree.NONE:
+			ids.append(child)
+			child = self.nextSibling[child]
+		return ids
+
+	def node(self, nid):
+		"""Return a Node facade on a node id"""
+		return Node(self.katago, tree=self, nid=nid)
+
 class Node:
 
 	"""
@@ -48,19 +389,115 @@ class Node:
 	- getPV() - to get the principal variation on current node with
 	  attached analysis values.
 	- getCurrentBoard().heat - to get heat informations.
+
+	Analyses are stored per position rather than per node: nodes reaching
+	the same position by different move orders share them (see 
+	isTransposition()).
+
+	## STORAGE
+
+	The tree is stored in a Tree arena and Node objects are thin facades 
+	over a node id. Attributes like .parent, .children, .board or .pv read
+	and write the arena, so facades can be created and dropped freely.
+	Two facades on the same node compare equal.
 	"""
 
-	def __init__(self, katago):
-		self.katago = katago
-		self.root = self
-		self.current = self
-		self.parent = self
-		self.children = []
-		self.board = None
-		self.move = None
-		self.loadedseq = []
-		self.loadId = 0
-		self.pv = []
+	def __init__(self, katago, tree=None, nid=0):
+		"""
+		- katago - KataGo object, used when creating a new tree
+		- tree, nid - optional, make a facade on the node 'nid' of 'tree'.
+		  If not set, a new tree is created with a single root node."""
+		if tree == None: tree = Tree(katago)
+		self.tree = tree
+		self.id = nid
+
+	def __eq__(self, other):
+		if not isinstance(other, Node): return False
+		return self.tree is other.tree and self.id == other.id
+
+	def __hash__(self):
+		return hash((id(self.tree), self.id))
+
+	# Attributes stored in the arena
+
+	@property
+	def katago(self):
+		return self.tree.katago
+
+	@property
+	def root(self):
+		return self.tree.node(self.tree.root)
+
+	@property
+	def current(self):
+		return self.tree.node(self.tree.current)
+
+	@property
+	def parent(self):
+		return self.tree.node(self.tree.parent[self.id])
+
+	@property
+	def children(self):
+		return [self.tree.node(nid) for nid in self.tree.childIds(self.id)]
+
+	@property
+	def board(self):
+		return self.tree.boards[self.id]
+
+	@board.setter
+	def board(self, board):
+		self.tree.boards[self.id] = board
+
+	@property
+	def move(self):
+		return decodeMove(self.tree.moves[self.id])
+
+	@move.setter
+	def move(self, move):
+		self.tree.moves[self.id] = encodeMove(move)
+		self.tree.touchChildren(self.id)
+		if self.board != None: self.tree.indexPosition(self.id)
+
+	@property
+	def pv(self):
+		return self.tree.store.get(self.tree.slots[self.id])[0]
+
+	@pv.setter
+	def pv(self, pv):
+		self.tree.store.update(self.tree.slots[self.id], pv=pv)
+		self.tree.touchSlot(self.tree.slots[self.id])
+
+	@property
+	def heat(self):
+		return self.tree.store.get(self.tree.slots[self.id])[1]
+
+	@heat.setter
+	def heat(self, heat):
+		self.tree.store.update(self.tree.slots[self.id], heat=heat)
+
+	@property
+	def rawnn(self):
+		return self.tree.store.get(self.tree.slots[self.id])[2]
+
+	@rawnn.setter
+	def rawnn(self, rawnn):
+		self.tree.store.update(self.tree.slots[self.id], rawnn=rawnn)
+
+	@property
+	def loadedseq(self):
+		return self.tree.loadedseq
+
+	@loadedseq.setter
+	def loadedseq(self, loadedseq):
+		self.tree.loadedseq = loadedseq
+
+	@property
+	def loadId(self):
+		return self.tree.loadId
+
+	@loadId.setter
+	def loadId(self, loadId):
+		self.tree.loadId = loadId
 
 	def print(self):
 		"""Print the whole historic"""
@@ -74,12 +511,13 @@ class Node:
 		self._getRoot().katago.analyse(ttime)
 
 	def setBoard(self, board, current=False):
-		"""Set the board.
+		"""Set the board. Its heat is not kept, as it comes with the analysis
+		(see getCurrentBoard).
 		- current - precise if we should do it on the current node"""
 		if current:
-			self._getCurrent().board = board.copy()
+			self._getCurrent().board = board.copy(heat=False)
 		else:
-			self.board = board.copy()
+			self.board = board.copy(heat=False)
 
 	def _setCurrentBoard(self, board):
 		"""Copy the current board at 'current'"""
@@ -89,38 +527,36 @@ class Node:
 		"""Set the root.
 
 		Use it this way: node = node.setRootHere()"""
-		cur = self._getCurrent()
-		cur.root = cur
-		cur.parent = cur
-		cur._setCurrent(cur)
-		return cur
+		tree = self.tree
+		tree.root = tree.current
+		tree.parent[tree.root] = tree.root
+		tree.line.reset()
+		return tree.node(tree.root)
 
 	def _getRoot(self):
 		"""Return the root history"""
-		cur = self
-		while cur != cur.root:
-			cur.root = cur.root.root
-			cur = cur.root
-		self.root = cur # Make sure there is compression
-		return cur
+		return self.tree.node(self.tree.root)
 
 	def _getPrevious(self):
 		"""Return the parent of the current node."""
-		if not self._getCurrent().parent:
-			return self._getCurrent()
 		return self._getCurrent().parent
 
 	def _getCurrent(self):
 		"""Return the current node"""
-		return self.root.current
+		return self.tree.node(self.tree.current)
 
 	def _setCurrent(self, ptr):
 		"""Set the current node"""
-		self._getRoot().current = ptr
+		self.tree.current = ptr.id
 
 	def getCurrentBoard(self):
-		"""Return the current board"""
-		return self._getCurrent().board
+		"""Return the current board, with the heat of its analysis - the
+		live one if any. The heat is removed when leaving the node."""
+		cur = self._getCurrent()
+		board = cur.board
+		heat = self.tree.live[1] if self.tree.live else cur.heat
+		if board != None and heat is not None: board.heat = heat
+		return board
 
 	def getLastMove(self):
 		"""Return the last move played - at current position"""
@@ -134,8 +570,9 @@ class Node:
 		Black. The 'normalized' parameter divied by the scoreStDev to take
 		accound of the complexity of the situation.""" 
 		pv = self.pv
-		if pv == []: return None
-		visits, winrate, scoreMean, scoreStDev, moves = pv[0]
+		if len(pv) == 0: return None
+		scoreMean = float(pv["scoreMean"][0])
+		scoreStDev = float(pv["scoreStdev"][0])
 		if scoreStDev <= 10: scoreStDev = 10
 		turn = self.getTurn(current=False)
 		if absolute:
@@ -150,106 +587,104 @@ class Node:
 
 	def scoreStdev(self):
 		pv = self.pv
-		if pv == []: return None
-		visits, winrate, scoreMean, scoreStdev, moves = pv[0]
-		return scoreStdev
+		if len(pv) == 0: return None
+		return float(pv["scoreStdev"][0])
 
 	def getCurrentScoreMean(self):
 		"""Return current score according to last analysis"""
 		return self._getCurrent().scoreMean()
 
 	def loadFileSequences(self, path):
-		"""Load a bunch of sequences from a file"""
+		"""Open a file of sequences and load the first. The file is a binary
+		dataset or a text file, according to its path (see dataset.py)."""
 		try:
-			myfile = open(path, "r")
-			if not myfile:
-				raise Exception("File do not exists")
-			txt = myfile.read()
-			seqtxt = txt.split("\n")
-			root = self._getRoot()
-			root.loadedseq = []
-			for line in seqtxt:
-				if line == "": continue
-				root.loadedseq.append(line)
-			root.loadId = -1
-			root.loadNextSeq()
-		except:
+			seqs = openSequences(path)
+		except OSError:
 			print("Failed to open {}".format(path))
+			return None
+		root = self._getRoot()
+		if hasattr(root.loadedseq, "close"): root.loadedseq.close()
+		root.loadedseq = seqs
+		root.loadId = -1
+		root.loadNextSeq()
 
 	def loadNextSeq(self):
-		"""Load next element of the .loadedseq at the root"""
+		"""Load next element of the .loadedseq at the root. Elements that
+		cannot be decoded are skipped."""
 		root = self._getRoot()
-		root.loadId += 1
-		if root.loadId < len(root.loadedseq):
-			root.fromSeqTxt(root.loadedseq[root.loadId], format="std")
-		else:
-			root.loadId -= 1
-			print("No more sequences")
+		for k in range(root.loadId + 1, len(root.loadedseq)):
+			if root._loadSeqAt(k): return None
+		print("No more sequences")
 
 	def loadPrevSeq(self):
-		"""Load previous element of the .loadedseq at the root"""
+		"""Load previous element of the .loadedseq at the root. Elements that
+		cannot be decoded are skipped."""
 		root = self._getRoot()
-		root.loadId -= 1
-		if root.loadId < 0:
-			root.loadId = 0
-			print("No more sequences")
-		elif root.loadedseq == []:
+		if len(root.loadedseq) == 0:
 			print("No sequences at all")
-		else:
-			root.fromSeqTxt(root.loadedseq[root.loadId], format="std")
+			return None
+		for k in range(root.loadId - 1, -1, -1):
+			if root._loadSeqAt(k): return None
+		print("No more sequences")
+
+	def _loadSeqAt(self, k):
+		"""Load the k-th element of the .loadedseq and prefetch its
+		neighbours. Return False if it cannot be decoded."""
+		try:
+			seq = self.loadedseq[k]
+		except Exception as e:
+			print("Failed to decode sequence {} ({})".format(k, e))
+			return False
+		self.loadId = k
+		self.loadSeq(*seq)
+		self.loadedseq.prefetch(k)
+		return True
 
 	def extraInfoStr(self):
 		"""Return a string corresponding to the current information.
 		Format is such that it can be parsed using katago.parseLine()."""
 		pv = self._getCurrent().getPV()
 		if pv == None: return ""
+		return encodeInfos(pv, self.getHeatInfos())
 
-		## Normal informations
-		txt = ""
-		for visits, winrate, scoreMean, scoreStdev, moves in pv:
-			txt += "info {} visits {} winrate {} scoreMean {} scoreStdev {} ".format(
-				coordToStd(*moves[0]), visits, winrate, scoreMean, scoreStdev)
-			txt += "pv "
-			for i, j in moves:
-				txt += "{} ".format(coordToStd(i, j))
-
-		## Ownership
-		txt += "ownership "
-		board = self._getCurrent().board
-		heat = board.heat
-		for i in range(19):
-			for j in range(19):
-				loc = "{} ".format(heat[j][i])
-				txt += loc
-
-		return txt
+	def getAnalyse(self):
+		"""Return the analysis of the current position and the heat of its
+		board, in the katago.parseLine() format"""
+		return self._getCurrent().getPV(), self.getHeatInfos()
+
+	def getHeatInfos(self):
+		"""Return the heat of the current board as a flat array, in the
+		katago.parseLine() order"""
+		return self.getCurrentBoard().heat.T.ravel()
 
 	def fromSeqTxt(self, txt, format="std"):
 		"""Little sister of getSeqToCurrent. Read it for more infos."""
-		self.goToRoot(transmit=True)
-		board = self._getCurrent().board
-		if txt == "": return None
-
-		txt = txt.split("@")
-		extrainfos = txt[1]
-		# print(extrainfos)
-		txt = txt[0].split(";")
-		for movtxt in txt:
-			if movtxt == "": break
-			movtxt = movtxt.split(".")
-			c = movtxt[0]
-			mov = movtxt[1]
-			if format == "std":
-				c = Board.BLACK if c == "B" else Board.WHITE
-				i, j = stdToCoord(mov)
-				self.playMove(board, i, j, c, transmit=True, analyse=False)
-			else:
-				raise Exception("Please finish implementation of fromSeqTxt")
-
-		infos, heatInfos = parseLine(extrainfos)
-		heatInfos = - heatInfos # negate ! don't know why anymore -.-
-		self.updPV(infos)
-		self.getCurrentBoard().loadHeatFromArray(heatInfos)
+		if txt == "":
+			self.goToRoot(transmit=True)
+			return None
+		self.loadSeq(*decodeSeq(txt, format))
+
+	def loadSeq(self, moves, analyse):
+		"""Play a sequence of moves (pla, i, j) from the root and load its
+		analysis, as returned by katago.parseLine(). Nodes are created 
+		without talking to KataGo, which is then synced in one write (see
+		seek)."""
+		tree = self.tree
+		start = tree.current
+		tree.current = tree.root
+		board = tree.boards[tree.root].copy(heat=False)
+		for pla, i, j in moves:
+			self.playMove(board, i, j, pla, transmit=False, analyse=False)
+		target = tree.node(tree.current)
+		tree.current = start
+		self.seek(target, transmit=True, analyse=False)
+
+		if analyse != None:
+			infos, heatInfos = analyse
+			heatInfos = - heatInfos # negate ! don't know why anymore -.-
+			board = self.getCurrentBoard()
+			board.loadHeatFromArray(heatInfos)
+			self.updPV(infos, board.heat)
 
 		#self.startAnalyse()
 		print("Loaded sequence.")
@@ -260,58 +695,28 @@ class Node:
 		- format : "std" for standard - pla is 'B' or 'W' and move is standard
 		and "coord" for coordinates with pla being '1' or '2' and move 
 		is coordinates '([row],[col])'. """
-		cur = self._getCurrent()
-		root = self._getRoot()
-		moves = []
-		while True:
-			if cur.move != None:
-				moves.append(cur.move)
-			if cur == root or cur == cur.parent: break
-			cur = cur.parent
-		moves.reverse()
-
-		res = ""
-		for pla, i, j in moves:
-			if format == "coord": 
-				res += "{}.({},{});".format(pla, i, j)
-			if format == "std":
-				c = "B" if pla == Board.BLACK else "W"
-				res += "{}.{};".format(c, coordToStd(i, j))
-		
-		res += "@" + self.extraInfoStr()
-		return res
+		return encodeSeq(self.getMovesToCurrent(), format) + "@" \
+			+ self.extraInfoStr()
+
+	def getMovesToCurrent(self):
+		"""Return the list of moves (pla, i, j) from root to current"""
+		tree = self.tree
+		tree.line.sync()
+		moves = [decodeMove(tree.moves[nid]) for nid in tree.line.ids]
+		return [move for move in moves if move != None]
 
 	def getScoreSeq(self, normalized=False):
-		"""Return the list of score from root to current"""
-		cur = self._getCurrent()
-		root = self._getRoot()
-		scores = [0]
-		while True:
-			score = cur.scoreMean(normalized=normalized)
-			if not score: score = scores[-1]
-			scores.append(score)
-			if cur == root or cur == cur.parent: break
-			cur = cur.parent
-		
-		scores.reverse()
-		scores.pop()
-		return scores
+		"""Return the array of scores from root to current. Nodes with no
+		analysis take the score of the next analysed one."""
+		return self.tree.line.get("normalized" if normalized else "score")
 
 	def getScoreStdevSeq(self):
-		"""Return the list of scoreStDev form root to current"""
-		cur = self._getCurrent()
-		root = self._getRoot()
-		seqStdev = [0]
-		while True:
-			scoreStdev = cur.scoreStdev()
-			if not scoreStdev: scoreStdev = seqStdev[-1]
-			seqStdev.append(scoreStdev)
-			if cur == root or cur == cur.parent: break
-			cur = cur.parent
-		
-		seqStdev.reverse()
-		seqStdev.pop()
-		return seqStdev
+		"""Return the array of scoreStDev form root to current"""
+		return self.tree.line.get("stdev")
+
+	def getWinrateSeq(self):
+		"""Return the array of Black's winrates from root to current"""
+		return self.tree.line.get("winrate")
 
 	def getTurn(self, current=True):
 		"""Get which turn it is (Board.BLACK or Board.WHITE)
@@ -324,8 +729,9 @@ class Node:
 			return Board.getOpponent(pla)
 
 	def getPV(self, current=True):
-		"""Return current main variations"""
+		"""Return current main variations - the live ones if any"""
 		if current:
+			if self.tree.live: return self.tree.live[0]
 			return self._getCurrent().pv
 		else:
 			return self.pv
@@ -334,28 +740,48 @@ class Node:
 		"""Return information (if some) on the current move
 		- ceil - ignored parameters"""
 		pvs = self.getPV()
-		if pvs == None: return None
-		for visits, winrate, scoreMean, scoreStDev, moves in pvs:
-			if moves[0] == (i, j):
-				return visits, winrate, scoreMean, scoreStDev, moves
-		return None
-
-	def updPV(self, pv):
-		"""Update current principal variations"""
-		self._getCurrent().pv = pv
+		if pvs == None or len(pvs) == 0: return None
+		k = pvs.find(i, j)
+		if k < 0: return None
+		return pvs[k]
+
+	def updPV(self, pv, heat=None):
+		"""Update current principal variations, and the heat that comes with
+		them. They are always shown, but only replace the stored analysis,
+		shared by transpositions, once they have more visits: KataGo 
+		restarts its search from scratch on each position."""
+		cur = self._getCurrent()
+		if not isinstance(pv, Infos): pv = Infos.fromList(pv)
+		self.tree.live = pv, heat
+		if totalVisits(pv) >= totalVisits(cur.pv):
+			cur.pv = pv
+			if heat is not None: cur.heat = heat
+
+	def isTransposition(self):
+		"""Return True if the current position is reached by other nodes"""
+		return self.tree.isTransposition(self.tree.current)
+
+	def getRawNN(self):
+		"""Return the raw network evaluation of the current position, as
+		returned by katago.parseRawNN(), or None"""
+		return self._getCurrent().rawnn
+
+	def updRawNN(self, rawnn, heat=None):
+		"""Update the raw network evaluation of the current position. Its
+		heat is kept until the position is analysed."""
+		cur = self._getCurrent()
+		cur.rawnn = rawnn
+		if heat is not None and len(cur.pv) == 0: cur.heat = heat
 
 	def addChild(self, board):
-		"""Add a child. 
+		"""Add a child and return it. 
 		If the children already exists, do not add it"""
-		for child in self._getCurrent().children:
-			if child.board.key == board.key:
-				return None
-		node = Node(self._getRoot().katago)
-		node.parent = self._getCurrent()
-		node.root = self._getRoot()
-		node.current = self._getCurrent()
-		node.setBoard(board, current=False)
-		self._getCurrent().children.append(node)
+		tree = self.tree
+		nid = tree.findChild(tree.current, board.key)
+		if nid == Tree.NONE:
+			nid = tree.newNode(tree.current)
+			tree.setChildBoard(nid, board.copy(heat=False))
+		return tree.node(nid)
 		
 	def goForward(self, ttime=TTIME, transmit=True, analyse=True):
 		"""Go to the leftmost child. If there is no child, print an error 
@@ -371,6 +797,7 @@ class Node:
 				self._getRoot().katago.playCoord(i, j, pla)
 				# if analyse: self._getRoot().katago.analyse(ttime)
 				self._getRoot().katago.key = self.getCurrentBoard().key
+				if analyse: self._getRoot().katago.evaluate()
 			return self.getCurrentBoard()
 
 	def undo(self, ttime=TTIME, transmit=True, analyse=True):
@@ -383,17 +810,14 @@ class Node:
 				self._getRoot().katago.undo()
 				# if analyse: self._getRoot().katago.analyse(ttime)
 				self._getRoot().katago.key = self.getCurrentBoard().key
+				if analyse: self._getRoot().katago.evaluate()
 			return self.getCurrentBoard()
 		else:
 			return self._getRoot().board
 
 	def playBoard(self, board):
 		"""Move to a children. If it does not exists, create it."""
-		self.addChild(board)
-		for child in self._getCurrent().children:
-			if child.board.key == board.key:
-				self._setCurrent(child)
-				return None
+		self.tree.current = self.addChild(board).id
 
 	def playMove(self, board, i, j, pla, transmit=True, analyse=True, ttime=TTIME):
 		"""Play a move on a board and add it in the history"""
@@ -407,15 +831,56 @@ class Node:
 		self.playBoard(board)
 		self._getRoot().katago.key = self.getCurrentBoard().key
 		self._getCurrent().move = pla, i, j
+		if transmit and analyse: self._getRoot().katago.evaluate()
 		return self._getCurrent().board
 
 	def goToRoot(self, transmit=False):
 		"""Set current as root"""
-		cur = self._getCurrent()
-		while cur != self._getRoot():
-			self.undo(transmit=transmit, analyse=False)
-			cur = cur._getPrevious()
-		self._setCurrent(self._getRoot())
+		self.seek(self._getRoot(), transmit=transmit, analyse=False)
+
+	def seek(self, node, transmit=True, analyse=True):
+		"""Jump to any node of the tree and return its board.
+
+		Every node stores its board, so the board is restored at once. If
+		transmit is set, KataGo is synced in a single write: undo up to the
+		common ancestor, then play down to the node."""
+		tree = self.tree
+		line = tree.line
+		line.sync()
+		pos = {nid: k for k, nid in enumerate(line.ids)}
+		down = []
+		nid = node.id
+		while nid not in pos:
+			down.append(nid)
+			nid = tree.parent[nid]
+		down.reverse()
+
+		tree.current = node.id
+		if transmit:
+			katago = tree.katago
+			undos = line.size - 1 - pos[nid]
+			katago.sync(undos, [decodeMove(tree.moves[k]) for k in down])
+			katago.key = self.getCurrentBoard().key
+			if analyse: katago.evaluate()
+		return self.getCurrentBoard()
+
+	def getLineNode(self, n):
+		"""Return the node at move 'n' of the current line. The line goes 
+		from the root to the current node, then follows the first children.
+		If the line is shorter, return its last node."""
+		tree = self.tree
+		line = tree.line
+		line.sync()
+		if n < line.size: return tree.node(line.ids[max(n, 0)])
+		nid = tree.current
+		for k in range(n - line.size + 1):
+			if tree.firstChild[nid] == Tree.NONE: break
+			nid = tree.firstChild[nid]
+		return tree.node(nid)
+
+	def seekMove(self, n, transmit=True, analyse=True):
+		"""Jump to move 'n' of the current line (see getLineNode)"""
+		return self.seek(self.getLineNode(n), transmit, analyse)
 
 	def localLoss(self, normalized=True):
 		"""Return the loss for current move in history"""
@@ -433,14 +898,25 @@ class Node:
 		return nextnode.scoreMean(normalized=normalized) \
 			- self.scoreMean(normalized=normalized)
 
-	def guessLevel(self, lookpla=Board.BLACK, normalized=True, forgetBarrier=0.5):
-		"""Guess the level of a player"""
+	def guessLevel(self, lookpla=Board.BLACK, normalized=True, 
+		forgetBarrier=FORGET_BARRIER):
+		"""Guess the level of a player. With default parameters, it is read
+		from the running statistics of the line, in O(1)."""
+		if normalized and forgetBarrier == FORGET_BARRIER:
+			count, mean, var, ewma = self.getLevelStats(lookpla)
+			if count == 0: return None
+			return LVLMUL * mean
 		losses = self.getLossList(lookpla, normalized, forgetBarrier)
 		# print("Loss:", np.array(losses))
 		return LVLMUL * cumulate(losses)[-1]
 
 
-	def getLossList(self, lookpla, normalized=True, forgetBarrier=0.5):
+	def getLevelStats(self, lookpla=Board.BLACK):
+		"""Return (count, mean, variance, moving average) of the normalized 
+		losses of a player, from root to current"""
+		return self.tree.line.levelStats(lookpla, self.getTurn())
+
+	def getLossList(self, lookpla, normalized=True, forgetBarrier=FORGET_BARRIER):
 		"""Return the list of losses for a player"""
 		scores = self.getScoreSeq(normalized=False)
 		stdev = self.getScoreStdevSeq()
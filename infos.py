@@ -0,0 +1,93 @@
+import numpy as np
+
+# Values of a candidate move. 'move' is the first move of the PV, stored as
+# 'i * 19 + j' like the moves of the PV buffer.
+INFO_DTYPE = np.dtype([("visits", "i4"), ("winrate", "f4"),
+	("scoreMean", "f4"), ("scoreStdev", "f4"), ("prior", "f4"), ("lcb", "f4"),
+	("order", "i2"), ("move", "i2")])
+
+class Infos:
+
+	"""Candidate moves of an analysis, as sent by kata-analyze.
+
+	The values of the candidates are rows of a NumPy structured array (see
+	INFO_DTYPE), and all their principal variations are stored in one flat
+	uint16 buffer of moves 'i * 19 + j': the PV of the k-th candidate is
+	moves[offsets[k]:offsets[k+1]].
+
+	For compatibility, an Infos object also behaves as the list of tuples
+	(visits, winrate, scoreMean, scoreStDev, pv) it replaces, pv being a
+	list of coordinates (i, j). Columns are read with infos["visits"].
+
+	The candidate playing at each point is found with a 19x19 index array,
+	built the first time it is needed (see find())."""
+
+	def __init__(self, rows=None, moves=None, offsets=None):
+		if rows is None: rows = np.zeros(0, dtype=INFO_DTYPE)
+		if moves is None: moves = np.zeros(0, dtype="uint16")
+		if offsets is None: offsets = np.zeros(len(rows) + 1, dtype="uint32")
+		self.rows = rows
+		self.moves = moves
+		self.offsets = offsets
+		self._index = None
+
+	@staticmethod
+	def fromList(infos):
+		"""Build Infos from a list of (visits, winrate, scoreMean, scoreStDev,
+		pv) tuples. Missing values (prior, lcb) are 0."""
+		rows = np.zeros(len(infos), dtype=INFO_DTYPE)
+		offsets = np.zeros(len(infos) + 1, dtype="uint32")
+		moves = []
+		for k, (visits, winrate, scoreMean, scoreStDev, pv) in enumerate(infos):
+			first = pv[0][0] * 19 + pv[0][1] if pv else -1
+			rows[k] = visits, winrate, scoreMean, scoreStDev, 0, 0, k, first
+			moves += [i * 19 + j for i, j in pv]
+			offsets[k+1] = len(moves)
+		return Infos(rows, np.array(moves, dtype="uint16"), offsets)
+
+	def __len__(self):
+		return len(self.rows)
+
+	def __getitem__(self, k):
+		"""Return a column if 'k' is a field name, else the k-th candidate as
+		a (visits, winrate, scoreMean, scoreStDev, pv) tuple"""
+		if isinstance(k, str): return self.rows[k]
+		if k < 0: k += len(self.rows)
+		if not 0 <= k < len(self.rows): raise IndexError(k)
+		visits, winrate, scoreMean, scoreStdev = self.rows[k].item()[:4]
+		return visits, winrate, scoreMean, scoreStdev, self.pv(k)
+
+	def __iter__(self):
+		for k in range(len(self.rows)):
+			yield self[k]
+
+	def pv(self, k):
+		"""Return the principal variation of the k-th candidate, as a list
+		of coordinates (i, j)"""
+		moves = self.moves[self.offsets[k]:self.offsets[k+1]]
+		return [divmod(m, 19) for m in moves.tolist()]
+
+	@property
+	def index(self):
+		"""19x19 array of the index of the candidate playing at each point,
+		or -1. If several candidates play the same point, the first one."""
+		if self._index is None:
+			moves = self.rows["move"]
+			valid = np.flatnonzero((moves >= 0) & (moves < 361))[::-1]
+			index = np.full(361, -1, dtype="int16")
+			index[moves[valid]] = valid
+			self._index = index.reshape(19, 19)
+		return self._index
+
+	def find(self, i, j):
+		"""Return the index of the candidate playing at (i, j), or -1"""
+		if not (0 <= i < 19 and 0 <= j < 19): return -1
+		return int(self.index[i, j])
+
+	def totalVisits(self):
+		"""Return the number of visits of the analysis"""
+		return int(self.rows["visits"].sum())
+
+	@property
+	def nbytes(self):
+		return self.rows.nbytes + self.moves.nbytes + self.offsets.nbytes
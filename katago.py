@@ -1,25 +1,33 @@
 import sys
 from sdl2 import *
-from threading import Thread
+from threading import Thread, Lock
 import time
 import subprocess
 import os
+from collections import deque
 
 from board import *
+from infos import Infos, INFO_DTYPE
+from ringbuffer import AnalysisRing
+import daemon
 
 def parseLine(line):
-	"""Load informations from an extracted line. Return True if the line
-	was valid, and False otherwise."""
+	"""Load informations from an extracted line. Return (infos, heatInfos),
+	infos being an infos.Infos object, or None if the line was not valid."""
 	#print(line)
 	t = time.time()
 	txt = line.split()
 	i = 0
-	infos = []
+	rows = []
+	moves = []
+	offsets = [0]
 	visits = 0
 	winrate = 0
 	scoreMean = 0
 	scoreStDev = 0
-	pv = []
+	prior = 0
+	lcb = 0
+	order = -1
 	correct = False
 	while i < len(txt):
 		tok = txt[i]
@@ -35,55 +43,155 @@ def parseLine(line):
 		elif tok == "scoreStdev":
 			i, tok = i+1, txt[i+1]
 			scoreStDev = float(tok)
+		elif tok == "prior":
+			i, tok = i+1, txt[i+1]
+			prior = float(tok)
+		elif tok == "lcb":
+			i, tok = i+1, txt[i+1]
+			lcb = float(tok)
+		elif tok == "order":
+			i, tok = i+1, txt[i+1]
+			order = int(tok)
 		elif tok == "pv":
-			pv = []
+			first = len(moves)
 			i, tok = i+1, txt[i+1]
 			while tok != "info" and tok != "ownership":
-				pv.append(stdToCoord(tok))
+				mi, mj = stdToCoord(tok)
+				moves.append(mi * 19 + mj)
 				i, tok = i+1, txt[i+1]
-			infos.append((visits, winrate, scoreMean, scoreStDev, pv))			 
+			if order < 0: order = len(rows)
+			rows.append((visits, winrate, scoreMean, scoreStDev, prior, lcb,
+				order, moves[first] if len(moves) > first else -1))
+			offsets.append(len(moves))
+			prior, lcb, order = 0, 0, -1
 		
 		if tok == "ownership":
-			i += 1 # skip the 'ownership' token
+			i += 1 # skip the 'ownership' token
 			correct = True
 			break
 		i += 1
 	if correct:
-		heatInfos = np.zeros(361)
-		for j in range(361):
-			heatInfos[j] = float(txt[i+j])
+		heatInfos = np.array(txt[i:i+361], dtype=float)
+		infos = Infos(np.array(rows, dtype=INFO_DTYPE),
+			np.array(moves, dtype="uint16"), np.array(offsets, dtype="uint32"))
 		dt = time.time() - t
 		return infos, heatInfos
 	return None
 
+def pushEvent(katago, code):
+	"""Push a KataGo SDL event. 'code' tells what kind of event it is."""
+	ev = SDL_Event()
+	ev.type = katago.eventID
+	ev.user.code = code
+	SDL_PushEvent(ev)
+
+def treatOutput(katago, analyse, line=None):
+	"""Treat a line of KataGo's output, already parsed by parseLine()
+	- line - optional, the raw line. Needed to read 'kata-raw-nn' outputs."""
+	katago.lastOutput = time.time()
+	# Raw network evaluations are answered outside of the command count
+	if line != None and katago.feedRawNN(line): return None
+	# So is the notice of a daemon giving our engine to another client
+	if line != None and line.strip() == daemon.STOPPED:
+		katago.displace()
+		return None
+	katago.updocount()
+	# print("Balance:", katago.ocount - katago.icount)
+	# katago.lastEventKey = katago.key
+	katago.lastAnalyse = analyse
+	if katago.lastAnalyse and katago.uptodate(): 
+		# do not care if this is not relevant info
+		pushEvent(katago, KataGo.ANALYSIS_EVENT)
+		katago.adaptInterval(analyse)
+
+	# Automatic analyze
+	elif katago.isON() and not katago.isSearching() and katago.uptodate() \
+		and not katago.displaced: 
+		# If katago.lastAnalyse is False, it means that KataGo is stopped
+		# If moreover, KataGo is ON, we start the analysis.
+		katago.analyse()
+
+def parseRawNN(lines):
+	"""Load informations from the output of 'kata-raw-nn', split in lists
+	of tokens. Return (whiteWin, whiteLead, policy, whiteOwnership), the two
+	last ones being arrays of 361 values, or None if the output is invalid."""
+	whiteWin, whiteLead = None, None
+	policy, ownership = None, None
+	i = 0
+	while i < len(lines):
+		tok = lines[i]
+		if tok == []: pass
+		elif tok[0] == "whiteWin":
+			whiteWin = float(tok[1])
+		elif tok[0] == "whiteLead":
+			whiteLead = float(tok[1])
+		elif tok[0] in ("policy", "whiteOwnership"):
+			values = np.zeros(361)
+			for row in range(19):
+				for col in range(19):
+					values[row * 19 + col] = float(lines[i+row+1][col])
+			if tok[0] == "policy": policy = values
+			else: ownership = values
+			i += 19
+		i += 1
+	if whiteWin == None or policy is None or ownership is None:
+		return None
+	if whiteLead == None: whiteLead = 0
+	return whiteWin, whiteLead, policy, ownership
+
 # Thanks stackoverflow ! 
 # https://stackoverflow.com/questions/375427/non-blocking-read-on-a-subprocess-pipe-in-python
 def enqueue_output(out, katago):
 	for line in iter(out.readline, b''):
-		katago.updocount()
-		# print("Balance:", katago.ocount - katago.icount)
-		# katago.lastEventKey = katago.key
-		katago.lastAnalyse = parseLine(line.decode())
-		if katago.lastAnalyse and katago.uptodate(): 
-			# do not care if this is not relevant info
-			ev = SDL_Event()
-			ev.type = katago.eventID
-			SDL_PushEvent(ev)
-
-		# Automatic analyze
-		elif katago.isON() and not katago.isSearching() and katago.uptodate(): 
-			# If katago.lastAnalyse is False, it means that KataGo is stopped
-			# If moreover, KataGo is ON, we start the analysis.
-			ttime = 100 # centiseconds
-			katago.analyse(ttime)
+		line = line.decode()
+		treatOutput(katago, parseLine(line), line)
 
 	out.close()
+	# The pipe is closed: either we asked KataGo to quit, or it died.
+	katago.restart(out)
+
+def enqueue_parsed(conn, out, katago):
+	"""Same as enqueue_output, when lines are parsed by a child process.
+	Slots of katago.ring are received for analyses, and raw lines
+	otherwise."""
+	try:
+		while True:
+			msg = conn.recv()
+			if isinstance(msg, str):
+				treatOutput(katago, None, msg)
+			else:
+				treatOutput(katago, katago.ring.read(msg))
+	except EOFError:
+		pass
+
+	conn.close()
+	out.close()
+	if katago.closing: katago.ring.close()
+	katago.restart(out)
+
+def supervise(katago):
+	"""Watch KataGo while it is searching or has commands to answer. If no
+	output came for more than KataGo.TIMEOUT seconds (STARTUP_TIMEOUT while
+	it starts), the process is killed - the reader thread then notices the
+	closed pipe and respawns it."""
+	while katago.isON():
+		time.sleep(1)
+		if katago.closing: break
+		pending = not katago.uptodate() or len(katago.rawKeys) > 0
+		if not katago.isSearching() and not pending: continue
+		timeout = KataGo.STARTUP_TIMEOUT if katago.ocount < 0 \
+			else KataGo.TIMEOUT
+		if time.time() - katago.lastOutput > timeout:
+			print("KataGo did not answer for {} seconds, killing it".format(
+				timeout))
+			katago.pid.kill()
 
 class KataGo:
 
 	"""'<class KataGo>' is a binder to the real KataGo program.
 	Creating a KataGo object will spawn a child thread one can send 
-	commands to and get information.
+	commands to and get information. If KataGo.DAEMON is set, the object 
+	is a client of a running daemon (see daemon.py) instead.
 
 	Below are values to be modified according to KataGo's directory
 	on your computer."""
@@ -93,7 +201,33 @@ class KataGo:
 	CONFIG = None
 	THINKING_TIME = 1000 # in centiseconds
 	ANALYSIS_CMD = "kata-analyze interval {} ownership true"
+	RAWNN_CMD = "kata-raw-nn 0"
+	RAW_PREVIEW = True # evaluate new positions with the raw network
 	ANALYSIS_DIR = "analysis"
+	TIMEOUT = 30 # in seconds, without output while searching or answering
+	STARTUP_TIMEOUT = 300 # in seconds, without output while loading
+	PARSE_PROCESS = False # parse KataGo's output in a child process
+	DAEMON = None # path to the socket of a daemon to use instead of KataGo
+	# Restarts. KataGo exiting within TIMEOUT seconds of its launch, or
+	# failing to launch, is a failure. The delay before the next attempt
+	# starts at RETRY seconds and doubles on each consecutive failure,
+	# until MAX_FAILURES are reached and KataGo is turned off.
+	RETRY = 1
+	MAX_FAILURES = 5
+
+	# Reporting interval of the analysis, in centiseconds. A search starts
+	# reporting every MIN_INTERVAL, and backs off up to MAX_INTERVAL when
+	# the score stabilises (moves less than STABLE_SCORE points). It also
+	# doubles each time the visits double past VISITS: later reports
+	# change the analysis less.
+	MIN_INTERVAL = 10
+	MAX_INTERVAL = 200
+	STABLE_SCORE = 0.5
+	VISITS = 1000
+
+	# Codes of the SDL events pushed by KataGo
+	ANALYSIS_EVENT = 0
+	RAWNN_EVENT = 1
 
 	def __init__(self, eventID, config=None, model=None, turnoff=False):
 		"""
@@ -102,6 +236,43 @@ class KataGo:
 		- model - optional, path to a model (.txt.gz)
 		- turnoff - optional. Is set to True, the KataGo is a dead end.
 		  use it you want to use the app with no KataGo subprocess."""
+		self.lastAnalyse = None
+		self.eventID = eventID
+		self.closing = False
+		self.lock = Lock()
+
+		# Game state, replayed when KataGo has to be respawned
+		self.boardsize = 19
+		self.komi = 7.5
+		self.moves = []
+		self.analysisCmd = None
+		
+		# Searching state (boolean)
+		self.searching = False
+		# In client mode, set when the daemon gave our engine to another
+		# client. The analysis is not resumed until the position changes.
+		self.displaced = False
+
+		# Adaptive reporting interval
+		self.interval = KataGo.MIN_INTERVAL
+		self.visitsInterval = KataGo.MIN_INTERVAL
+		self.searchInterval = None # interval of the running analysis
+		self.renderTime = 0 # in seconds
+		self.lastScore = None
+
+		# Raw network evaluation - lines are collected until the blank line.
+		# The keys of the positions asked are queued, in the order KataGo
+		# answers.
+		self.lastRawNN = None
+		self.rawLines = None
+		self.rawKeys = deque()
+
+		self.key = 0
+		self.lastEventKey = 0 # FIXME: this is bad
+
+		# Number of consecutive failed restarts
+		self.failures = 0
+
 		if turnoff:
 			print("Warning: KataGo set OFF")
 			self._ON = False
@@ -112,34 +283,107 @@ class KataGo:
 		if not config: config = KataGo.CONFIG
 		if not model: model = KataGo.STDMODEL
 
-		cmd = "{} gtp -model {} -config {}".format(
-			KataGo.BIN, KataGo.STDMODEL, KataGo.CONFIG)
-		self.pid = subprocess.Popen(cmd.split(), stdin=subprocess.PIPE, 
-			stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1)
+		self.cmd = "{} gtp -model {} -config {}".format(
+			KataGo.BIN, model, config)
+
+		self.ring = AnalysisRing() if KataGo.PARSE_PROCESS else None
+		self._spawn()
+
+		self.watchdog = Thread(target=supervise, args=(self,))
+		self.watchdog.daemon = True
+		self.watchdog.start()
+
+	def _spawn(self):
+		"""Start the KataGo subprocess and its reader thread.
+		In client mode, connect to the daemon instead."""
+		if KataGo.DAEMON:
+			self.pid = daemon.Connection(KataGo.DAEMON)
+		else:
+			self.pid = subprocess.Popen(self.cmd.split(), stdin=subprocess.PIPE, 
+				stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1)
 		if not self.pid: 
 			raise Exception("Error when starting KataGo")
 
-		self.lastAnalyse = None
-		self.eventID = eventID
-		
-		# input count - number of sent commands
+		# input count - number of sent commands
 		self.icount = 0
-		# output count - number of outputs (counting lines)
+		# output count - number of outputs (counting lines)
 		# Waiting 3 lines at launch so initialized to -3
 		self.ocount = -3 
-		# Searching state (boolean)
-		self.searching = False
-
-		self.key = 0
-		self.lastEventKey = 0 # FIXME: this is bad
+		self.lastOutput = time.time()
+		self.spawnTime = self.lastOutput
+		# Pending raw network evaluations are lost with the process
+		self.rawLines = None
+		self.rawKeys = deque()
 
 		self.stdin = self.pid.stdin.fileno()
 		self.stdout = self.pid.stdout.fileno()
 
-		self.thread = Thread(target=enqueue_output, args=(self.pid.stdout, self))
+		if self.ring:
+			conn = self.ring.start(self.stdout, parseLine)
+			self.thread = Thread(target=enqueue_parsed,
+				args=(conn, self.pid.stdout, self))
+		else:
+			self.thread = Thread(target=enqueue_output,
+				args=(self.pid.stdout, self))
 		self.thread.daemon = True
 		self.thread.start()
 
+	def restart(self, out=None):
+		"""Respawn KataGo with the same model and configuration, then replay
+		the game state in one write and resume the running analysis.
+		In client mode, reconnect to the daemon instead. Consecutive
+		failures are retried with an exponential backoff, and KataGo is
+		turned off after KataGo.MAX_FAILURES of them.
+		- out - optional, the pipe of the reader thread asking for a restart.
+		  Ignored if KataGo has already been respawned meanwhile."""
+		with self.lock:
+			if self.closing: return None
+			if out != None and out != self.pid.stdout: return None
+			self.pid.kill()
+			code = self.pid.wait()
+			if KataGo.DAEMON:
+				print("Connection to the daemon lost, reconnecting")
+			else:
+				print("KataGo exited (code {}), restarting".format(code))
+			if time.time() - self.spawnTime < KataGo.TIMEOUT:
+				self.failures += 1
+			else:
+				self.failures = 0
+
+		while self.failures < KataGo.MAX_FAILURES:
+			if self.failures > 0:
+				delay = KataGo.RETRY * 2 ** (self.failures - 1)
+				print("Retrying in {} seconds".format(delay))
+				time.sleep(delay)
+			if self._respawn(): return None
+			self.failures += 1
+			print("Failed to {}".format("reach the daemon" if KataGo.DAEMON
+				else "start KataGo"))
+
+		print("KataGo failed {} times in a row, turning it off".format(
+			self.failures))
+		self._ON = False
+
+	def _respawn(self):
+		"""Spawn KataGo and replay the game state - see restart(). Return
+		False if KataGo could not be launched or the daemon reached."""
+		with self.lock:
+			if self.closing: return True
+			try:
+				self._spawn()
+			except OSError:
+				return False
+
+			player = {Board.BLACK: "B", Board.WHITE: "W"}
+			cmds = ["boardsize {}".format(self.boardsize),
+				"komi {}".format(self.komi)]
+			for pla, txt in self.moves:
+				cmds.append("play {} {}".format(player[pla], txt))
+			if self.searching and self.analysisCmd:
+				cmds.append(self.analysisCmd)
+			self._write(cmds)
+		return True
+
 	def isON(self):
 		"""
 		Return True if KataGo is ON (automatic analysis)
@@ -166,6 +410,19 @@ class KataGo:
 		if self.ocount < self.icount:
 			self.ocount += 1
 
+	def _write(self, cmds):
+		"""Write a list of commands to KataGo in a single write.
+
+		If the pipe is broken, the commands are dropped: the reader thread
+		will respawn KataGo and replay the game state."""
+		txt = "".join(cmd + "\n" for cmd in cmds)
+		try:
+			os.write(self.stdin, txt.encode())
+			# 'kata-raw-nn' answers are counted apart, see feedRawNN
+			self.icount += 2 * sum(cmd != KataGo.RAWNN_CMD for cmd in cmds)
+		except OSError:
+			print("Failed to write to KataGo")
+
 	def _sendCommand(self, cmd):
 		"""
 		Send a raw command to katago.
@@ -176,22 +433,25 @@ class KataGo:
 		if not self._ON: pass
 		else:
 			# print("Sending command:", cmd)
-			cmd += "\n"
-			os.write(self.stdin, cmd.encode())
-			self.icount += 2
+			with self.lock:
+				self._write([cmd])
 
 	def setBoardsize(self, size):
 		"""Set the boardsize of KataGo"""
+		self.boardsize = size
+		self.moves = []
 		self._sendCommand("boardsize {}".format(size))
 
 	def setKomi(self, komi):
 		"""Set the komi of KataGo"""
+		self.komi = komi
 		self._sendCommand("komi {}".format(komi))
 
 	def playStone(self, pla, txt):
 		"""play a stone on intersection corresponding to 'txt'"""
 		player = {Board.BLACK: "B", Board.WHITE: "W"}
 		cmd = "play {} {}".format(player[pla], txt)
+		self.moves.append((pla, txt))
 		self._sendCommand(cmd)
 
 	def playCoord(self, i, j, pla, size=19):
@@ -201,10 +461,12 @@ class KataGo:
 
 	def undo(self):
 		"""Undo the previous move"""
+		if self.moves != []: self.moves.pop()
 		self._sendCommand("undo")
 
 	def clearBoard(self):
 		"""Clear the board of KataGo"""
+		self.moves = []
 		self._sendCommand("clear_board")
 
 	def clearCache(self):
@@ -215,28 +477,139 @@ class KataGo:
 		"""Stop what KataGo is doing.
 
 		Use it when you want to stop an analysis currently running."""
-		self.searching = False
+		self._resetSearch()
 		self._sendCommand("stop")
 
+	def displace(self):
+		"""The daemon stopped our analysis for another client"""
+		print("Analysis stopped: the daemon's engine went to another viewer")
+		self._resetSearch()
+		self.displaced = True
+
+	def _resetSearch(self):
+		"""Forget about the running search"""
+		self.searching = False
+		self.displaced = False
+		self.interval = KataGo.MIN_INTERVAL
+		self.visitsInterval = KataGo.MIN_INTERVAL
+		self.lastScore = None
+
+	def sync(self, undos, moves):
+		"""Stop the analysis, undo 'undos' moves and play 'moves', a list of
+		(pla, i, j), in a single write."""
+		self._resetSearch()
+		player = {Board.BLACK: "B", Board.WHITE: "W"}
+		cmds = ["stop"] + ["undo"] * undos
+		for k in range(min(undos, len(self.moves))): self.moves.pop()
+		for pla, i, j in moves:
+			txt = coordToStd(i, j, self.boardsize)
+			cmds.append("play {} {}".format(player[pla], txt))
+			self.moves.append((pla, txt))
+		if not self._ON: return None
+		with self.lock:
+			self._write(cmds)
+
 	def close(self):
 		"""Close KataGo"""
+		self.closing = True
 		self._sendCommand("quit")
 
 	def playSeq(self, moves, clear=False):
 		"""Play a sequence of moves"""
-		if clear: self.clear()
+		if clear: self.clearBoard()
 		for pla, i, j in moves:
 			self.playCoord(i, j, pla)
 
+	def feedRawNN(self, line):
+		"""Collect the lines of a 'kata-raw-nn' answer. They are left out
+		of the command count, as the answer is much longer than the 2 lines
+		expected per command. Return True if the line belongs to such an
+		answer.
+
+		When the answer is complete, it is stored in .lastRawNN and an
+		event is pushed, unless the position it was asked for is not the
+		current one anymore."""
+		tokens = line.split()
+		if self.rawLines == None:
+			if "symmetry" not in tokens[:2]: return False
+			self.rawLines = []
+			return True
+		if tokens != []:
+			self.rawLines.append(tokens)
+			return True
+
+		rawnn = parseRawNN(self.rawLines)
+		self.rawLines = None
+		key = self.rawKeys.popleft() if self.rawKeys else None
+		if rawnn != None and key == self.key:
+			self.lastRawNN = rawnn
+			pushEvent(self, KataGo.RAWNN_EVENT)
+		return True
+
 	# More serious commands
 
-	def analyse(self, ttime=None):
+	def evaluate(self):
+		"""Ask a raw network evaluation of the current position. It comes
+		way faster than the first analysis and is used as a preview."""
+		if not KataGo.RAW_PREVIEW: return None
+		# The daemon does not serve raw network evaluations
+		if KataGo.DAEMON or not self._ON: return None
+		with self.lock:
+			self.rawKeys.append(self.key)
+			self._write([KataGo.RAWNN_CMD])
+
+	def setRenderTime(self, dt):
+		"""Record the time (in seconds) spent to render a frame.
+		KataGo will never report faster than that."""
+		self.renderTime = 0.8 * self.renderTime + 0.2 * dt
+
+	def getInterval(self):
+		"""Return the reporting interval to use, in centiseconds"""
+		return max(self.interval, self.visitsInterval,
+			int(100 * self.renderTime) + 1)
+
+	def adaptInterval(self, analyse):
+		"""Adapt the reporting interval to a new analysis. The interval 
+		doubles while the score is stable and halves when it moves, and
+		never goes below a floor growing with the visits.
+		If it changed enough, restart the analysis with the new interval."""
+		infos, heatInfos = analyse
+		if len(infos) == 0: return None
+		visits = int(infos["visits"].sum())
+		interval, threshold = KataGo.MIN_INTERVAL, KataGo.VISITS
+		while visits >= threshold and interval < KataGo.MAX_INTERVAL:
+			interval, threshold = 2 * interval, 2 * threshold
+		self.visitsInterval = min(interval, KataGo.MAX_INTERVAL)
+
+		scoreMean = float(infos["scoreMean"][0])
+		if self.lastScore != None:
+			if abs(scoreMean - self.lastScore) < KataGo.STABLE_SCORE:
+				self.interval = min(2 * self.interval, KataGo.MAX_INTERVAL)
+			else:
+				self.interval = max(self.interval // 2, KataGo.MIN_INTERVAL)
+		self.lastScore = scoreMean
+
+		ttime = self.getInterval()
+		if not self.searching or not self.searchInterval: return None
+		if ttime >= 2 * self.searchInterval or 2 * ttime <= self.searchInterval:
+			self.analyse(ttime, stop=True)
+
+	def analyse(self, ttime=None, stop=False):
 		"""Start KataGo's analysis - time is in centiseconds and controls
-		at which frequency katago's send analysis informations."""
-		if not ttime: ttime = KataGo.THINKING_TIME
+		at which frequency katago's send analysis informations.
+		If not set, the adaptive reporting interval is used.
+		- stop - optional, stop the running analysis first, in the same
+		  write, rather than relying on KataGo ending it on the next
+		  command."""
+		if not ttime: ttime = self.getInterval()
+		self.searchInterval = ttime
 		cmd = KataGo.ANALYSIS_CMD.format(ttime)
+		self.analysisCmd = cmd
 		self.searching = True
-		self._sendCommand(cmd)
+		self.displaced = False
+		if not self._ON: return None
+		with self.lock:
+			self._write(["stop", cmd] if stop else [cmd])
 			
 
 	
\ No newline at end of file
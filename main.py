@@ -4,6 +4,8 @@ from render import run
 from parser import *
 
 from katago import KataGo
+import daemon
+import store
 import yaml
 
 with open("config.yaml", 'r') as stream:
@@ -13,10 +15,22 @@ with open("config.yaml", 'r') as stream:
 KataGo.BIN = lconfig["KataGo.BIN"]
 KataGo.STDMODEL = lconfig["KataGo.STDMODEL"]
 KataGo.CONFIG = lconfig["KataGo.CONFIG"]
+KataGo.PARSE_PROCESS = lconfig.get("KataGo.PARSE_PROCESS", False)
+KataGo.DAEMON = lconfig.get("KataGo.DAEMON", None)
+daemon.SOCKET = lconfig.get("Daemon.SOCKET", daemon.SOCKET)
+daemon.ENGINES = lconfig.get("Daemon.ENGINES", daemon.ENGINES)
+daemon.CACHE = lconfig.get("Daemon.CACHE", daemon.CACHE)
+store.BUDGET = lconfig.get("Store.BUDGET", store.BUDGET)
+store.SPILL_DIR = lconfig.get("Store.SPILL_DIR", store.SPILL_DIR)
 
 if __name__ == "__main__":
 
 	print("Loaded configuration:", lconfig)
 
+	if parse_args().serve:
+		cmd = "{} gtp -model {} -config {}".format(
+			KataGo.BIN, KataGo.STDMODEL, KataGo.CONFIG)
+		daemon.serve(cmd, daemon.SOCKET, daemon.ENGINES)
+
 	run()
 	raise SystemExit(0)
@@ -13,9 +13,23 @@ parser.add_argument("--auto-play", type=str, dest="play",
 	help="set to white or black to make katago play automatically")
 parser.add_argument("--thinking-time", type=float, dest="kttime",
 	help="set the thinking time of katago in auto play mode")
+parser.add_argument("--parse-process", dest="parseprocess", action="store_true",
+	help="parse KataGo's output in a child process")
+parser.add_argument("--serve", dest="serve", action="store_true",
+	help="run as a daemon sharing KataGo between several visualizers")
+parser.add_argument("--connect", type=str, dest="daemon",
+	help="use the daemon listening on this socket instead of KataGo")
+parser.add_argument("--smooth-heat", dest="smoothheat", action="store_true",
+	help="interpolate the heat map between intersections")
+parser.add_argument("--max-fps", type=int, dest="maxfps",
+	help="maximum number of frames per second - the display refresh rate by\n"
+	"default")
 parser.set_defaults(skatago=True)
 parser.set_defaults(silent=False)
 parser.set_defaults(kttime=10.0)
+parser.set_defaults(parseprocess=False)
+parser.set_defaults(serve=False)
+parser.set_defaults(smoothheat=False)
 
 def parse_args():
 	return parser.parse_args()
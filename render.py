@@ -1,6 +1,12 @@
 import sys
 import ctypes
 import time
+import weakref
+import threading
+import queue
+import traceback
+import numpy as np
+from collections import OrderedDict
 
 from sdl2 import *
 from sdl2.sdlttf import *
@@ -9,9 +15,11 @@ import sdl2.sdlgfx as gfx
 
 from katago import KataGo
 from board import Board, coordToStd
-from history import Node
+from history import Node, LVLMUL
 import parser
 import sgffiles
+import dataset
+from graph import Graph
 
 DEBUG = False
 
@@ -33,6 +41,15 @@ SHOW_WHITE_HINTS = True
 SHOW_HEAT_MAP = True
 SHOW_VARIATION = True
 SHOW_DEAD_STONES = True
+# Overlays of the score diagram
+SHOW_WINRATE = False
+SHOW_STDEV = False
+# Interpolate the heat map between intersections
+SMOOTH_HEAT_MAP = False
+# Maximum number of frames per second - None for the display refresh rate
+MAX_FPS = None
+# Refresh rate used when the display does not report it
+DEFAULT_FPS = 60
 
 # The following are calculated values and not parameters:
 
@@ -49,6 +66,12 @@ WHITE = (255, 255, 255, 255)
 BLACK = (0, 0, 0, 255)
 GRAY  = lambda x: (x, x, x, 255)
 
+# Score diagram colors
+GRAPH_COLOR = GRAY(50)
+GLOW_WHITE = (255, 255, 255, 125)
+WINRATE_COLOR = (255, 140, 0, 255)
+STDEV_COLOR = (90, 150, 255, 255)
+
 # Hint colors
 HINT_COLOR = (240, 240, 5, 255)
 # Border color of the best move
@@ -69,6 +92,15 @@ def HEAT(x):
 	b = int(x * mb + (1 - x) * 255)
 	return (r, g, b, 255)
 
+# Vectorized HEAT: return the RGBA colors of an array of heat values, as an
+# array of uint8 with a last axis of size 4
+def HEAT_ARRAY(x):
+	x = np.asarray(x, dtype=float)[..., None]
+	main = np.where(x < 0, HEAT_BLACK, HEAT_RED)
+	colors = np.abs(x) * main + (1 - np.abs(x)) * 255
+	colors[..., 3] = 255
+	return colors.astype("uint8")
+
 #
 #  Global data
 #
@@ -90,6 +122,36 @@ tblackstone = None
 # Texture for white stones
 twhitestone = None
 
+# Sprites of the overlays, by name (see getSprite)
+sprites = {}
+
+# 19x19 streaming texture of the heat map, the goban-sized layer it is 
+# stretched on, and the colors they were updated with (see update_heat)
+theat = None
+theatmap = None
+lastHeat = None
+
+# Texture of the score diagram, and the graph it was updated with
+tgraph = None
+lastGraph = None
+
+# Static layers of the board (see createBoardLayers)
+tbackground = None
+tgrid = None
+
+# Back buffer, holding the last drawn scene (see draw_scene)
+tback = None
+lastScene = None
+# Scene being built, by thread: while set, drawing calls are recorded into
+# it (see recorder)
+recording = threading.local()
+
+# Text textures, by (font, string, color), in least recently used order.
+# Each entry is (texture, width, height).
+textTextures = OrderedDict()
+# Maximum number of cached text textures
+TEXT_CACHE = 512
+
 # Font for rendering, loaded from a TTF.
 font = None
 smallfont = None
@@ -173,16 +235,14 @@ def line(x1, y1, x2, y2, color):
 # - align_y can be "top", "center" or "bottom"
 def text(x, y, string, color=BLACK, tfont="normal", align_x="center", align_y="center"):
 	
+	if recorder() != None:
+		return recorder().record(x, y, text,
+			(x, y, string, color, tfont, align_x, align_y))
 	if tfont == "normal":
 		tfont = font
 	elif tfont == "tiny":
 		tfont = tinyfont
-	string = bytes(string, "utf8")
-	surface = TTF_RenderText_Blended(tfont, string, SDL_Color(*color))
-	texture = SDL_CreateTextureFromSurface(renderer, surface)
-
-	w = surface.contents.w
-	h = surface.contents.h
+	texture, w, h = textTexture(tfont, string, color)
 
 	if align_x == "center":
 		x -= w // 2
@@ -194,8 +254,31 @@ def text(x, y, string, color=BLACK, tfont="normal", align_x="center", align_y="c
 		y -= h
 
 	SDL_RenderCopy(renderer, texture, None, SDL_Rect(x, y, w, h))
+
+# Return the texture of a text, with its size, as (texture, width, height).
+# Textures are cached: the least recently used is destroyed when the cache 
+# holds more than TEXT_CACHE of them.
+def textTexture(tfont, string, color):
+	key = ctypes.addressof(tfont.contents), string, tuple(color)
+	if key in textTextures:
+		textTextures.move_to_end(key)
+		return textTextures[key]
+
+	surface = TTF_RenderText_Blended(tfont, bytes(string, "utf8"),
+		SDL_Color(*color))
+	texture = SDL_CreateTextureFromSurface(renderer, surface)
+	textTextures[key] = texture, surface.contents.w, surface.contents.h
 	SDL_FreeSurface(surface)
-	SDL_DestroyTexture(texture)
+	if len(textTextures) > TEXT_CACHE:
+		_, (old, _, _) = textTextures.popitem(last=False)
+		SDL_DestroyTexture(old)
+	return textTextures[key]
+
+# Destroy all the cached text textures
+def destroyTextTextures():
+	for texture, w, h in textTextures.values():
+		SDL_DestroyTexture(texture)
+	textTextures.clear()
 
 # Draws a circle, because gfx's filledCircle is terrible.
 def circle(cx, cy, radius, color):
@@ -232,6 +315,8 @@ def triangle(cx, cy, radius, color):
 #   and twhitestone to draw the stone. Otherwise, draw directly the stone.
 def stone(x, y, owner, mode="texture"):
 
+	if recorder() != None:
+		return recorder().record(x, y, stone, (x, y, owner, mode))
 	if mode == "texture":
 		if owner == "black" and tblackstone != None:
 			w, h = 2*STONE_RADIUS, 2*STONE_RADIUS
@@ -295,96 +380,364 @@ def destroyStoneTexture(color="black"):
 		SDL_DestroyTexture(twhitestone)
 
 
+# Draw the parts of the board that never change, on two layers:
+# - the background, coordinates and title, drawn under the heat map
+# - the goban lines, hoshi and boundary, drawn over it. The rest of this 
+#   layer is transparent.
+def draw_background():
+	clear(WHITE)
+	fillrect(0, HEIGHT - CONTROLS + 1, WIDTH, CONTROLS, GRAY(192))
+
+	text(3 * WIDTH // 4, HEIGHT - CONTROLS // 2, "KataGo Analyzer", BLACK)
+
+	# Coordinates
+	for i in range(1, 20):
+		x, y = inter(i, 1)
+		text(x, y - 24, ROWS[i-1], BLACK, align_x="center", align_y="bottom")
+		x, y = inter(i, 19)
+		text(x, y + 24, ROWS[i-1], BLACK, align_x="center", align_y="top")
+		x, y = inter(1, i)
+		text(x - 32, y, str(20-i), BLACK, align_x="center", align_y="center")
+		x, y = inter(19, i)
+		text(x + 32, y, str(20-i), BLACK, align_x="center", align_y="center")
+
+def draw_grid():
+	clear((255, 255, 255, 0))
+
+	## Goban lines - Hoshi
+	for i in range(1, 20):
+		line(*inter(1, i), *inter(19, i), GRAY(128))
+		line(*inter(i, 1), *inter(i, 19), GRAY(128))
+	for i in [4, 10, 16]:
+		for j in [4, 10, 16]:
+			x, y = inter(i, j)
+			circle(x, y, 3, GRAY(128))
+	# Goban boundary
+	line(*inter(1, 1),  *inter(1, 19),  BLACK)
+	line(*inter(1, 19), *inter(19, 19), BLACK)
+	line(*inter(1, 1),  *inter(19, 1),  BLACK)
+	line(*inter(19, 1), *inter(19, 19), BLACK)
+
+# Render the static layers of the board into tbackground and tgrid. Call it
+# again if the window size changes or the render targets are lost.
+def createBoardLayers():
+	global tbackground
+	global tgrid
+	destroyBoardLayers()
+
+	tbackground = SDL_CreateTexture(renderer, SDL_PIXELFORMAT_RGBA8888,
+		SDL_TEXTUREACCESS_TARGET, WIDTH, HEIGHT)
+	SDL_SetRenderTarget(renderer, tbackground)
+	draw_background()
+
+	tgrid = SDL_CreateTexture(renderer, SDL_PIXELFORMAT_RGBA8888,
+		SDL_TEXTUREACCESS_TARGET, WIDTH, HEIGHT)
+	SDL_SetTextureBlendMode(tgrid, SDL_BLENDMODE_BLEND)
+	SDL_SetRenderTarget(renderer, tgrid)
+	draw_grid()
+	SDL_SetRenderTarget(renderer, None)
+
+def destroyBoardLayers():
+	global tbackground
+	global tgrid
+	if tbackground != None: SDL_DestroyTexture(tbackground)
+	if tgrid != None: SDL_DestroyTexture(tgrid)
+	tbackground, tgrid = None, None
+
+# The rectangle of the whole goban, one cell around each intersection
+def goban_rect():
+	return SDL_Rect(MARGIN, MARGIN, 19 * CELL_SIZE, 19 * CELL_SIZE)
+
+# Update the heat map. It is a 19x19 texture, with one texel per 
+# intersection, stretched once on a goban-sized layer, so that parts of it 
+# are drawn without scaling. Both are only updated when the heat changes.
+# - colors - colors[j][i] is the RGBA color of the intersection at column i,
+#   row j, see HEAT_ARRAY
+def update_heat(colors):
+	global theat
+	global theatmap
+	global lastHeat
+
+	if theat == None:
+		theat = SDL_CreateTexture(renderer, SDL_PIXELFORMAT_RGBA32,
+			SDL_TEXTUREACCESS_STREAMING, 19, 19)
+		mode = SDL_ScaleModeLinear if SMOOTH_HEAT_MAP else SDL_ScaleModeNearest
+		SDL_SetTextureScaleMode(theat, mode)
+		lastHeat = None
+	if theatmap == None:
+		goban = goban_rect()
+		theatmap = SDL_CreateTexture(renderer, SDL_PIXELFORMAT_RGBA8888,
+			SDL_TEXTUREACCESS_TARGET, goban.w, goban.h)
+		lastHeat = None
+
+	if lastHeat is None or not np.array_equal(colors, lastHeat):
+		pixels = np.ascontiguousarray(colors)
+		SDL_UpdateTexture(theat, None, pixels.ctypes.data, 19 * 4)
+		target = SDL_GetRenderTarget(renderer)
+		SDL_SetRenderTarget(renderer, theatmap)
+		SDL_RenderCopy(renderer, theat, None, None)
+		SDL_SetRenderTarget(renderer, target)
+		lastHeat = pixels
+
+# Draw the heat map, see update_heat
+def draw_heat():
+	SDL_RenderCopy(renderer, theatmap, None, goban_rect())
+
+def destroyHeatTexture():
+	global theat
+	global theatmap
+	global lastHeat
+	if theat != None: SDL_DestroyTexture(theat)
+	if theatmap != None: SDL_DestroyTexture(theatmap)
+	theat, theatmap, lastHeat = None, None, None
+
 def circ_mark(x, y, owner):
+	sprite(("mark", owner), x, y)
+
+# Draw the mark of the last move, see circ_mark
+def draw_mark(x, y, owner):
 	main, border = (BLACK, WHITE) if owner == "black" else (WHITE, BLACK)
 	r = STONE_RADIUS // 2
 	gfx.aacircleRGBA(renderer, x, y, r, *border)
 
-# Draw the score diagram
-# - scores - list of scores (should be color-constant)
-def drawScoreList(scores):
-	if len(scores) <= 1: return None
+#
+#  Sprites
+#  Overlays are pre-rendered once into small transparent textures, and then
+#  drawn as texture copies. Sprites are named by tuples:
+#  - ("hint",) - fill of a hint stone, see hint_stone
+#  - ("hintborder", isFirst) - border of a hint stone
+#  - ("mark", owner) - mark of the last move, see circ_mark
+#  - ("triangle", radius, color) - dead stone mark, see draw_dead_stones
+#
+
+# Create a sprite: a transparent texture of size 2*radius+1, on which 'draw' 
+# draws around the center (radius, radius). Return (texture, radius).
+def createSprite(radius, draw):
+	size = 2 * radius + 1
+	texture = SDL_CreateTexture(renderer, SDL_PIXELFORMAT_RGBA8888,
+		SDL_TEXTUREACCESS_TARGET, size, size)
+	SDL_SetRenderTarget(renderer, texture)
+	SDL_SetTextureBlendMode(texture, SDL_BLENDMODE_BLEND)
+	SDL_SetRenderDrawBlendMode(renderer, SDL_BLENDMODE_NONE)
+	clear((255, 255, 255, 0))
+	draw(radius, radius)
+	SDL_SetRenderDrawBlendMode(renderer, SDL_BLENDMODE_NONE)
+	SDL_SetRenderTarget(renderer, None)
+	return texture, radius
+
+# Return the sprite named 'key', creating it the first time
+def getSprite(key):
+	if key in sprites: return sprites[key]
+	r = STONE_RADIUS
+	if key[0] == "hint":
+		sprites[key] = createSprite(r, draw_hint_fill)
+	elif key[0] == "hintborder":
+		isFirst = key[1]
+		sprites[key] = createSprite(r + 2,
+			lambda x, y: draw_hint_border(x, y, isFirst))
+	elif key[0] == "mark":
+		owner = key[1]
+		sprites[key] = createSprite(r // 2 + 1,
+			lambda x, y: draw_mark(x, y, owner))
+	elif key[0] == "triangle":
+		radius, color = key[1], key[2]
+		sprites[key] = createSprite(radius,
+			lambda x, y: triangle(x, y, radius, color))
+	return sprites[key]
+
+# Draw a sprite centered on (x, y)
+# - alpha - opacity of the sprite, from 0 to 255
+def sprite(key, x, y, alpha=255):
+	if recorder() != None:
+		return recorder().record(x, y, sprite, (key, x, y, alpha))
+	texture, radius = getSprite(key)
+	SDL_SetTextureAlphaMod(texture, alpha)
+	size = 2 * radius + 1
+	SDL_RenderCopy(renderer, texture, None,
+		SDL_Rect(x - radius, y - radius, size, size))
+
+def destroySprites():
+	for texture, radius in sprites.values():
+		SDL_DestroyTexture(texture)
+	sprites.clear()
+
+# Return the graph of the score diagram of the current line, see graph.Graph.
+# It is only computed again when the line or the shown overlays change.
+def getGraph(history):
+	global graphCache
+	scores = history.getScoreSeq()
+	stdevs = history.getScoreStdevSeq() if SHOW_STDEV else None
+	winrates = history.getWinrateSeq() if SHOW_WINRATE else None
+	key = scores, stdevs, winrates
+	if graphCache != None and all(a is b for a, b in zip(key, graphCache[0])):
+		return graphCache[1]
+	graph = Graph(WIDTH // 2, CONTROLS, scores, stdevs, winrates)
+	graphCache = key, graph
+	return graph
+
+# Last graph returned by getGraph, with the sequences it was computed from
+graphCache = None
+
+# Return the runs of True in a mask, as a list of (start, end)
+def runs(mask):
+	edges = np.flatnonzero(np.diff(np.concatenate(([0], mask, [0]))))
+	return list(zip(edges[0::2].tolist(), edges[1::2].tolist()))
+
+# Fill one span of pixels per column
+# - x - column of the first span
+# - spans - array of (top, bottom) rows, as returned by graph.decimate
+def fillColumns(x, spans, color):
+	n = len(spans)
+	rects = np.zeros((n, 4), dtype=np.int32)
+	rects[:, 0] = np.arange(x, x + n)
+	rects[:, 1] = spans[:, 0]
+	rects[:, 2] = 1
+	rects[:, 3] = spans[:, 1] - spans[:, 0] + 1
+	SDL_SetRenderDrawColor(renderer, *color)
+	SDL_RenderFillRects(renderer,
+		rects.ctypes.data_as(ctypes.POINTER(SDL_Rect)), n)
+
+# Update the texture of the score diagram. Only the columns that changed
+# since the last update are drawn again.
+# - graph - a graph.Graph
+def updateGraph(graph):
+	global tgraph
+	global lastGraph
+
+	if tgraph == None:
+		tgraph = SDL_CreateTexture(renderer, SDL_PIXELFORMAT_RGBA8888,
+			SDL_TEXTUREACCESS_TARGET, graph.width, graph.height)
+		lastGraph = None
+	dirty = graph.dirty(lastGraph)
+	if not dirty.any(): return None
+
+	target = SDL_GetRenderTarget(renderer)
+	SDL_SetRenderTarget(renderer, tgraph)
+	SDL_SetRenderDrawBlendMode(renderer, SDL_BLENDMODE_NONE)
+	overlays = (("stdevup", STDEV_COLOR), ("stdevdown", STDEV_COLOR),
+		("winrate", WINRATE_COLOR))
+	for start, end in runs(dirty):
+		fillrect(start, 0, end - start, graph.height, GRAPH_COLOR)
+		line(start, graph.middle, end - 1, graph.middle, GRAY(192))
+		for y in graph.guides:
+			line(start, y, end - 1, y, GLOW_WHITE)
+		fillColumns(start, graph.series["area"][start:end], GLOW_WHITE)
+		for name, color in overlays:
+			if name in graph.series:
+				fillColumns(start, graph.series[name][start:end], color)
+	SDL_SetRenderTarget(renderer, target)
+	lastGraph = graph
+
+# Draw the score diagram, see updateGraph
+# - graph - a graph.Graph
+def drawScoreList(graph):
+	SDL_RenderCopy(renderer, tgraph, None,
+		SDL_Rect(0, HEIGHT - CONTROLS + 1, graph.width, graph.height))
+
+def destroyGraphTexture():
+	global tgraph
+	global lastGraph
+	if tgraph != None: SDL_DestroyTexture(tgraph)
+	tgraph, lastGraph = None, None
+
+# Draw the estimated level of both players, from their running statistics
+def drawLevels(history):
+	levels = []
+	for pla, name in ((Board.BLACK, "B"), (Board.WHITE, "W")):
+		count, mean, var, ewma = history.getLevelStats(pla)
+		if count == 0: levels.append("{}: -".format(name))
+		else: levels.append("{}: {:.0f} ({:.0f})".format(name, 
+			LVLMUL * mean, LVLMUL * ewma))
+	text(3 * WIDTH // 4, HEIGHT - CONTROLS // 2 - 20,
+		"Level " + "  ".join(levels), BLACK)
+
+# Return the move of the score diagram under the mouse, or None
+# - num - number of scores in the diagram
+def getGraphMove(inputs, num):
 	if not SHOW_BLACK_HINTS or not SHOW_WHITE_HINTS: return None
+	if inputs.mousex == None or num <= 1: return None
+	if inputs.mousey <= HEIGHT - CONTROLS or inputs.mousex >= WIDTH // 2:
+		return None
+	return round(inputs.mousex * (num - 1) / (WIDTH // 2))
 
-	GLOW_WHITE = (255, 255, 255, 125)
-	srWidth = WIDTH//2
-	srHeight = CONTROLS	
-	fillrect(0, HEIGHT - CONTROLS + 1, srWidth, CONTROLS, GRAY(50))
-	m = min(-5, min(scores)) - 1
-	M = max(5, max(scores)) + 1
-	num = len(scores)
-	dx = srWidth / (num - 1)
 
-	x = 0
-	prevx = None
-	prevy = None
-
-	middle = int(HEIGHT - CONTROLS * m / (m - M) + 1)
-	line(0, middle, srWidth, middle, GRAY(192))
-
-	five = 5 * (m // 5)
-	while five <= M:
-		l = (five - m) / (M - m)
-		y = int(HEIGHT - CONTROLS * l + 1)
-		line(0, y, srWidth, y, GLOW_WHITE)
-		five += 5
-
-	for i, score in enumerate(scores):
-		l = (score - m) / (M - m)
-		y = int(HEIGHT - CONTROLS * l + 1)
-		x = int(i * dx)
-		if prevx != None:
-			delta = (y - prevy) / dx
-			v = prevy
-			for u in range(prevx, x):
-				line(u, middle, u, int(v), GLOW_WHITE)
-				v += delta	 
-			# line(prevx, prevy, x, y, GRAY(0))
-		prevx, prevy = x, y
-
-
-# Draw a sequence of moves
-# - moves - ordered coordinates list
-# - pla - player playing first in the sequence
-def draw_moves(moves, pla, limit=99):
-	getowner = lambda c: "black" if c == Board.BLACK else "white"
-	getcolor = lambda c: WHITE if c == Board.BLACK else BLACK 
-	for i, (col, row) in enumerate(moves):
-		if i >= limit: break
-		col, row = col + 1, row + 1
-		stone(*inter(row, col), getowner(pla), mode="texture")
-		if i < 9:
-			text(*inter(row, col), str(i+1), color=getcolor(pla))
+# Return the board at the end of the variation of the hovered candidate, as
+# returned by Board.playVariation, or None if no candidate is hovered. It is
+# computed once per analysis and candidate.
+# - pv - the analysis
+# - turn - player of the first move
+def getVariation(pv, turn, board, coord=None):
+
+	if turn == Board.BLACK and not SHOW_BLACK_HINTS:
+		return None
+	if turn == Board.WHITE and not SHOW_WHITE_HINTS:
+		return None
+
+	global SHOW_VARIATION
+	SHOW_VARIATION = SHOW_BLACK_HINTS and SHOW_WHITE_HINTS
+
+	k = pv.find(*coord) if coord != None else -1
+	if k < 0: return None
+	moves = pv.pv(k)
+	i, j = moves[0]
+	if board.stones[i][j] != Board.EMPTY: return None
+
+	# Show the whole sequence only if 'show_variation' is on, else just one
+	# move
+	limit = len(moves) if SHOW_VARIATION else 1
+	cache = variations.setdefault(pv, {})
+	if (k, limit) not in cache:
+		cache[(k, limit)] = board.playVariation(moves[:limit], turn)
+	return cache[(k, limit)]
+
+# Boards at the end of variations, by analysis and (candidate, length). 
+# Entries go away with their analysis.
+variations = weakref.WeakKeyDictionary()
+
+# Number the stones of a variation
+# - stones, numbers - as returned by Board.playVariation
+def draw_variation(stones, numbers):
+	for (i, j), n in numbers.items():
+		color = WHITE if stones[i][j] == Board.BLACK else BLACK
+		if n < 10:
+			text(*inter(j+1, i+1), str(n), color=color)
 		else:
-			text(*inter(row, col), str(i+1), color=getcolor(pla), tfont=smallfont)
-		pla = Board.getOpponent(pla)
+			text(*inter(j+1, i+1), str(n), color=color, tfont=smallfont)
 
 # Mark dead stones. Stones are marked according to the heat map.
 # A stone is considered probably dead if it is landing in the opponent's 
 # teritory.
 # board - a board object
-def draw_dead_stones(board):
-	for row in range(1, 20):
-		for col in range(1, 20):
-			owner = board.stones[col-1][row-1]
-			p = board.deadValue(row-1, col-1)
-			if p > 0:
-				color = WHITE if owner == Board.BLACK else BLACK
-				radius = int((1 + p) * STONE_RADIUS // 3)
-				triangle(*inter(row, col), radius, color)
+# stones - the stones shown, if not the board's. Only the stones of the board
+# still shown are marked.
+def draw_dead_stones(board, stones=None):
+	shown = np.transpose(board.stones if stones is None else stones)
+	stones = np.transpose(board.stones)
+	signs = np.select([stones == Board.BLACK, stones == Board.WHITE], [1, -1])
+	deads = signs * board.heat * (shown == stones) # see Board.deadValue
+	for row, col in np.argwhere(deads > 0).tolist():
+		p = deads[row][col]
+		color = WHITE if stones[row][col] == Board.BLACK else BLACK
+		radius = int((1 + p) * STONE_RADIUS // 3)
+		sprite(("triangle", radius, color), *inter(row+1, col+1))
 
 # Draw a inting stone
 # - intensity - for the alpha-transparency
 # - isFirst - set to Trye to draw a thick read border
 def hint_stone(x, y, intensity=0.5, isFirst=False):
-	r, g, b, a = HINT_COLOR
-	a = int(255 * intensity)
-	main = r, g, b, a
+	sprite(("hint",), x, y, alpha=int(255 * intensity))
+	sprite(("hintborder", isFirst), x, y)
+
+# Draw the fill of a hint stone, see hint_stone
+def draw_hint_fill(x, y):
+	r = STONE_RADIUS
+	circle(x, y, r-2, HINT_COLOR)
+	gfx.aacircleRGBA(renderer, x, y, r-2, *HINT_COLOR)
+
+# Draw the border of a hint stone, see hint_stone
+def draw_hint_border(x, y, isFirst=False):
 	border = PV_COLOR if isFirst else HINT_COLOR
-	
 	r = STONE_RADIUS
-	circle(x, y, r-2, main)
-	gfx.aacircleRGBA(renderer, x, y, r-2, *main)
 	gfx.aacircleRGBA(renderer, x, y, r-1, *border)
 	gfx.aacircleRGBA(renderer, x, y, r, *border)
 	if isFirst: gfx.aacircleRGBA(renderer, x, y, r+1, *border)
@@ -416,50 +769,240 @@ def hint_info(x, y, visits, score):
 #  Hint rendering function
 #
 
-def render_hints(pv, turn, board, coord=None):
+def render_hints(pv, turn, board, variation=None):
 
 	if turn == Board.BLACK and not SHOW_BLACK_HINTS:
 		return None
 	if turn == Board.WHITE and not SHOW_WHITE_HINTS:
 		return None
 
-	global SHOW_VARIATION
-	SHOW_VARIATION = SHOW_BLACK_HINTS and SHOW_WHITE_HINTS
-
-	maxVisits = 0
-	for visits, _, _, _, _ in pv:
-		maxVisits = max(maxVisits, visits)
-	if maxVisits == 0: maxVisits = 1
-
-	drawnSeq = False
-	for _, _, _, _, moves in pv:
-		i, j = moves[0]
-		if moves[0] == coord and board.stones[i][j] == Board.EMPTY:
-			if SHOW_VARIATION: 
-				# Show the whole sequence only if 'show_variation' is on
-				draw_moves(moves, turn)
-			else:
-				# Else, just draw one move
-				draw_moves([moves[0]], turn)
-			drawnSeq = True
+	## Hovered candidate - its variation replaces the hints
+	if variation != None:
+		draw_variation(*variation)
+		return None
 
-	if drawnSeq: return None
+	if len(pv) == 0: return None
+	visits = pv["visits"]
+	maxVisits = max(int(visits.max()), 1)
 
 	isFirst = True
-	for i, (visits, winrate, scoreMean, scoreStDev, moves) in enumerate(pv):
-		if i >= HINT_LIMIT: break
-		col, row = moves[0]
+	scores = pv["scoreMean"]
+	for k, move in enumerate(pv["move"][:HINT_LIMIT].tolist()):
+		col, row = divmod(move, 19)
 		if board.stones[col][row] != Board.EMPTY: continue
-		hint_stone(*inter(row+1, col+1), intensity=visits/maxVisits, isFirst=isFirst)
+		hint_stone(*inter(row+1, col+1), intensity=visits[k]/maxVisits, isFirst=isFirst)
 		if SHOW_BLACK_HINTS and SHOW_WHITE_HINTS:
-			hint_info(*inter(row+1, col+1), visits, scoreMean)
+			hint_info(*inter(row+1, col+1), int(visits[k]), float(scores[k]))
 		isFirst = False
 
+# Draw the raw network evaluation, until the first analysis comes
+# - rawnn - as returned by katago.parseRawNN()
+def render_preview(rawnn, turn, board):
+
+	if turn == Board.BLACK and not SHOW_BLACK_HINTS:
+		return None
+	if turn == Board.WHITE and not SHOW_WHITE_HINTS:
+		return None
+
+	whiteWin, whiteLead, policy, ownership = rawnn
+	policy = np.nan_to_num(policy, nan=0)
+	maxPolicy = max(policy.max(), 1e-6)
+
+	for k in np.argsort(-policy)[:HINT_LIMIT]:
+		if policy[k] <= 0: break
+		i, j = divmod(int(k), 19)
+		if board.stones[i][j] != Board.EMPTY: continue
+		hint_stone(*inter(j+1, i+1), intensity=policy[k]/maxPolicy)
+
+	lead = - whiteLead
+	leadstr = "B+{:.1f}".format(lead) if lead > 0 else "W+{:.1f}".format(-lead)
+	text(3 * WIDTH // 4, HEIGHT - CONTROLS // 2 + 20,
+		"Raw NN: {} ({:.0f}% B)".format(leadstr, 100 * (1 - whiteWin)), BLACK)
+
+#
+#  Scenes
+#  A scene describes a frame: the heat map colors, and the calls to stone,
+#  sprite and text, recorded by the cell of the goban or the region of the
+#  controls they are drawn in. The back buffer keeps the last drawn scene,
+#  and only the cells and regions whose calls changed are drawn again.
+#
+
+# Regions of the controls. Calls recorded out of the goban and the controls
+# are in the "margin" region, which is the whole window.
+def region_rect(name):
+	split = WIDTH // 2 + 1
+	if name == "graph": return SDL_Rect(0, HEIGHT - CONTROLS, split, CONTROLS)
+	if name == "info":
+		return SDL_Rect(split, HEIGHT - CONTROLS, WIDTH - split, CONTROLS)
+	return None
+
+def region_at(x, y):
+	if y < HEIGHT - CONTROLS: return "margin"
+	return "graph" if x <= WIDTH // 2 else "info"
+
+# Overlays may overflow their cell by a few pixels, dirty cells are drawn
+# again with this padding.
+DIRTY_PADDING = 2
+# Above this number of dirty cells, the whole goban is drawn again
+DIRTY_LIMIT = 120
+
+# Return the scene being built by the current thread, or None
+def recorder():
+	return getattr(recording, "scene", None)
+
+class Scene:
+
+	def __init__(self):
+		# colors of the heat map, see update_heat - None if hidden
+		self.heat = None
+		# cell (i, j) or region name -> list of calls (order, func, args)
+		self.calls = {}
+		self.count = 0
+
+	# Record a call of func(*args) drawn around (x, y)
+	def record(self, x, y, func, args):
+		key = getCoordinates(x, y)
+		if key == None: key = region_at(x, y)
+		self.add(key, func, args)
+
+	# Record a call of func(*args) in a cell or a region
+	def add(self, key, func, args):
+		self.calls.setdefault(key, []).append((self.count, func, args))
+		self.count += 1
+
+	def get(self, key):
+		return [(func, args) for order, func, args in self.calls.get(key, ())]
+
+	# Return the cells and the regions that differ from a previous scene,
+	# as a 19x19 mask and a set of region names.
+	def diff(self, prev):
+		dirty = np.zeros((19, 19), dtype=bool)
+		regions = set()
+		for key in set(self.calls) | set(prev.calls):
+			if self.get(key) == prev.get(key): continue
+			if isinstance(key, tuple): dirty[key] = True
+			else: regions.add(key)
+
+		if (self.heat is None) != (prev.heat is None): dirty[:] = True
+		elif self.heat is not None:
+			changed = np.any(self.heat != prev.heat, axis=2)
+			if SMOOTH_HEAT_MAP:
+				# Interpolated colors depend on the neighbours
+				grown = changed.copy()
+				grown[1:] |= changed[:-1]
+				grown[:-1] |= changed[1:]
+				grown[:, 1:] |= changed[:, :-1]
+				grown[:, :-1] |= changed[:, 1:]
+				changed = grown
+			dirty |= changed
+		return dirty, regions
+
+# Return the areas to draw again for a mask of dirty cells, as a list of 
+# (rect, keys): the rect to draw, and the cells whose calls may draw in it.
+# Dirty cells are merged in horizontal runs.
+def dirty_areas(dirty):
+	pad = DIRTY_PADDING
+	if dirty.sum() > DIRTY_LIMIT:
+		goban = goban_rect()
+		rect = SDL_Rect(goban.x - pad, goban.y - pad,
+			goban.w + 2 * pad, goban.h + 2 * pad)
+		return [(rect, [(i, j) for i in range(19) for j in range(19)])]
+
+	areas = []
+	for i in np.flatnonzero(dirty.any(axis=1)).tolist():
+		for start, j in runs(dirty[i]):
+			rect = SDL_Rect(MARGIN + CELL_SIZE * start - pad,
+				MARGIN + CELL_SIZE * i - pad,
+				CELL_SIZE * (j - start) + 2 * pad, CELL_SIZE + 2 * pad)
+			keys = [(a, b) for a in range(max(i - 1, 0), min(i + 2, 19))
+				for b in range(max(start - 1, 0), min(j + 1, 19))]
+			areas.append((rect, keys))
+	return areas
+
+# Draw an area of a scene on the current target: the static layers and the
+# heat map under it, and the calls of some cells and regions, in the order
+# they were recorded.
+# - rect - the area, clipped, or None for the whole window
+# - keys - cells and region names whose calls are drawn
+def draw_area(scene, rect, keys, goban=True):
+	SDL_RenderSetClipRect(renderer, rect)
+	SDL_RenderCopy(renderer, tbackground, rect, rect)
+	if goban:
+		if scene.heat is not None: draw_heat()
+		SDL_RenderCopy(renderer, tgrid, goban_rect(), goban_rect())
+	calls = sorted(call for key in keys for call in scene.calls.get(key, ()))
+	for order, func, args in calls:
+		func(*args)
+	SDL_RenderSetClipRect(renderer, None)
+
+# Draw a scene. Only what changed since the last drawn scene is drawn on the 
+# back buffer, which is then copied to the window.
+def draw_scene(scene):
+	global tback
+	global lastScene
+
+	## Background, coordinates, title and goban lines - pre-rendered
+	if tbackground == None:
+		createBoardLayers()
+		lastScene = None
+	if tback == None:
+		tback = SDL_CreateTexture(renderer, SDL_PIXELFORMAT_RGBA8888,
+			SDL_TEXTUREACCESS_TARGET, WIDTH, HEIGHT)
+		lastScene = None
+
+	## Sprites, the heat map and the score diagram are rendered on their own
+	## targets, update them beforehand
+	if scene.heat is not None: update_heat(scene.heat)
+	for calls in scene.calls.values():
+		for order, func, args in calls:
+			if func == sprite: getSprite(args[0])
+			if func == drawScoreList: updateGraph(args[0])
+
+	SDL_SetRenderTarget(renderer, tback)
+	if lastScene != None:
+		dirty, regions = scene.diff(lastScene)
+	if lastScene == None or "margin" in regions:
+		draw_area(scene, None, list(scene.calls))
+	else:
+		for rect, keys in dirty_areas(dirty):
+			draw_area(scene, rect, keys)
+		for name in regions:
+			draw_area(scene, region_rect(name), [name], goban=False)
+	SDL_SetRenderTarget(renderer, None)
+
+	SDL_RenderCopy(renderer, tback, None, None)
+	SDL_RenderPresent(renderer)
+	lastScene = scene
+
+# Render again the pre-rendered textures, after the render targets are lost
+def resetTargets():
+	createBoardLayers()
+	destroySprites()
+	destroyHeatTexture()
+	destroyGraphTexture()
+	destroyBackBuffer()
+
+# Destroy all the textures, but the stones'
+def destroyTextures():
+	destroyTextTextures()
+	destroyBoardLayers()
+	destroyHeatTexture()
+	destroySprites()
+	destroyGraphTexture()
+	destroyBackBuffer()
+
+def destroyBackBuffer():
+	global tback
+	global lastScene
+	if tback != None: SDL_DestroyTexture(tback)
+	tback, lastScene = None, None
+
 #
 #  Board rendering function
 #
 
-def render(board, history, coord=None):
+# Describe the frame of the current position as a Scene
+def build_scene(board, history, coord=None):
 
 	## Getting informations
 	# - pla : color of current player 
@@ -469,47 +1012,21 @@ def render(board, history, coord=None):
 	pv = history.getPV()
 	lmove = history.getLastMove()
 
-	## Clear the board - draw mondain rectangles and text
-	clear(WHITE)
-	fillrect(0, HEIGHT - CONTROLS + 1, WIDTH, CONTROLS, GRAY(192))
+	scene = Scene()
+	recording.scene = scene
 
-	text(3 * WIDTH // 4, HEIGHT - CONTROLS // 2, "KataGo Analyzer", BLACK)
+	## Hovered variation - the board is shown as it is at its end
+	variation = getVariation(pv, history.getTurn(), board, coord)
+	shown = board.stones if variation == None else variation[0]
 
 	## Heat map
 	if SHOW_HEAT_MAP:
-		for row in range(1, 20):
-			for col in range(1, 20):
-				fillrect(*cell_rect(row, col), HEAT(board.heat[row-1][col-1]))
-
-	## Goban lines - Hoshi
-	for i in range(1, 20):
-		line(*inter(1, i), *inter(19, i), GRAY(128))
-		line(*inter(i, 1), *inter(i, 19), GRAY(128))
-	for i in [4, 10, 16]:
-		for j in [4, 10, 16]:
-			x, y = inter(i, j)
-			circle(x, y, 3, GRAY(128))
-	# Goban boundary
-	line(*inter(1, 1),  *inter(1, 19),  BLACK)
-	line(*inter(1, 19), *inter(19, 19), BLACK)
-	line(*inter(1, 1),  *inter(19, 1),  BLACK)
-	line(*inter(19, 1), *inter(19, 19), BLACK)
-	# Coordinates
-	for i in range(1, 20):
-		x, y = inter(i, 1)
-		text(x, y - 24, ROWS[i-1], BLACK, align_x="center", align_y="bottom")
-		x, y = inter(i, 19)
-		text(x, y + 24, ROWS[i-1], BLACK, align_x="center", align_y="top")
-		x, y = inter(1, i)
-		text(x - 32, y, str(20-i), BLACK, align_x="center", align_y="center")
-		x, y = inter(19, i)
-		text(x + 32, y, str(20-i), BLACK, align_x="center", align_y="center")
-
+		scene.heat = HEAT_ARRAY(np.transpose(board.heat))
 
 	## Stones
 	for row in range(1, 20):
 		for col in range(1, 20):
-			st = board.stones[col - 1][row - 1]
+			st = shown[col - 1][row - 1]
 
 			if st == Board.BLACK:
 				stone(*inter(row, col), "black", mode="texture")
@@ -517,18 +1034,25 @@ def render(board, history, coord=None):
 				stone(*inter(row, col), "white", mode="texture")
 
 	## Mark last move
-	if lmove:
+	if lmove and shown[lmove[1]][lmove[2]] == lmove[0]:
 		pla, col, row = lmove
 		owner = "black" if pla == Board.BLACK else "white"
 		circ_mark(*inter(row+1, col+1), owner)
 
 	## Rendering Hints & variations & score diagram
-	if SHOW_DEAD_STONES: draw_dead_stones(board)
-	render_hints(pv, board=board, turn=history.getTurn(), coord=coord)
+	if SHOW_DEAD_STONES: draw_dead_stones(board, shown)
+	render_hints(pv, board=board, turn=history.getTurn(), variation=variation)
+	if history.isTransposition():
+		text(3 * WIDTH // 4, HEIGHT - CONTROLS // 2 + 35, "Transposition", BLACK)
+	if len(pv) == 0 and history.getRawNN():
+		render_preview(history.getRawNN(), turn=history.getTurn(), board=board)
 	if SHOW_WHITE_HINTS and SHOW_BLACK_HINTS: 
-		drawScoreList(history.getScoreSeq())
-	
-	SDL_RenderPresent(renderer)
+		if len(history.getScoreSeq()) > 1:
+			scene.add("graph", drawScoreList, (getGraph(history),))
+		drawLevels(history)
+
+	recording.scene = None
+	return scene
 
 ## Init board, katago and history
 # SDL_KATAGO - SDL event corresponding to KataGo's analysis
@@ -588,6 +1112,8 @@ def treatInput(event, board, kata, history, inputs):
 	global SHOW_WHITE_HINTS
 	global SHOW_HEAT_MAP
 	global SHOW_DEAD_STONES
+	global SHOW_WINRATE
+	global SHOW_STDEV
 	global ltime
 
 	srun, srender = True, False
@@ -595,6 +1121,20 @@ def treatInput(event, board, kata, history, inputs):
 		if DEBUG: print("EVENT: quit")
 		srun = False
 
+	## RENDER TARGETS LOST - pre-rendered layers must be rendered again
+	elif event.type == SDL_RENDER_TARGETS_RESET:
+		if DEBUG: print("EVENT: render targets reset")
+		srender = True # the main thread already reset them
+
+	## KATAGO - raw network preview, replaced as soon as analyses come
+	elif event.type == SDL_KATAGO and event.user.code == KataGo.RAWNN_EVENT:
+		if kata.lastRawNN and len(history.getPV()) == 0:
+			if DEBUG: print("Event: katago raw network")
+			whiteWin, whiteLead, policy, ownership = kata.lastRawNN
+			board.loadHeatFromArray(- ownership)
+			history.updRawNN(kata.lastRawNN, board.heat)
+			srender = True
+
 	## KATAGO
 	elif event.type == SDL_KATAGO:
 		if kata.lastAnalyse:
@@ -602,8 +1142,8 @@ def treatInput(event, board, kata, history, inputs):
 			infos, heatInfos = kata.lastAnalyse
 			
 			heatInfos = Board.getSign(history.getTurn(current=True)) * heatInfos
-			history.updPV(infos)
 			board.loadHeatFromArray(heatInfos)
+			history.updPV(infos, board.heat)
 			srender = True
 
 			if args.play:
@@ -634,6 +1174,16 @@ def treatInput(event, board, kata, history, inputs):
 			board = history.undo(transmit=True, analyse=True)
 			ltime = time.time() + 1e6
 
+		elif event.key.keysym.sym == SDLK_HOME:
+			history.setBoard(board, current=True) # save current board
+			board = history.seek(history._getRoot())
+			ltime = time.time() + 1e6
+
+		elif event.key.keysym.sym == SDLK_END:
+			history.setBoard(board, current=True) # save current board
+			board = history.seekMove(len(history.tree.parent))
+			ltime = time.time() + 1e6
+
 		elif event.key.keysym.sym == SDLK_w:
 			SHOW_WHITE_HINTS = not SHOW_WHITE_HINTS
 
@@ -646,14 +1196,24 @@ def treatInput(event, board, kata, history, inputs):
 		elif event.key.keysym.sym == SDLK_d:
 			SHOW_DEAD_STONES = not SHOW_DEAD_STONES
 
+		elif event.key.keysym.sym == SDLK_r:
+			SHOW_WINRATE = not SHOW_WINRATE
+
+		elif event.key.keysym.sym == SDLK_s:
+			SHOW_STDEV = not SHOW_STDEV
+
 		elif event.key.keysym.sym == SDLK_g:
 			path = input("Write into: ")
 			if path != "":
 				try:
-					txt = history.getSeqToCurrent()
-					myfile = open(path, "a+")
-					print(txt, file=myfile)
-					myfile.close()
+					if dataset.isDataset(path):
+						dataset.append(path, history.getMovesToCurrent(),
+							history.getAnalyse())
+					else:
+						txt = history.getSeqToCurrent()
+						myfile = open(path, "a+")
+						print(txt, file=myfile)
+						myfile.close()
 					print("Written description at {}".format(path))
 					srender = False
 				except:
@@ -690,9 +1250,9 @@ def treatInput(event, board, kata, history, inputs):
 		# moves
 		if lastCoord == None: lastCoord = -2, -2
 		if coord == None: coord = -2, -2
-		lastmoveInfo = history.getMoveInfo(*lastCoord)
-		moveInfo = history.getMoveInfo(*coord)
-		if (lastmoveInfo != None or moveInfo != None) and lastCoord != coord:
+		pv = history.getPV()
+		hinted = pv.find(*lastCoord) >= 0 or pv.find(*coord) >= 0
+		if hinted and lastCoord != coord:
 			srender = True
 			if DEBUG: print("EVENT: Taking account of motion")
 
@@ -700,8 +1260,14 @@ def treatInput(event, board, kata, history, inputs):
 	elif event.type == SDL_MOUSEBUTTONDOWN:
 		if DEBUG: print("EVENT: mouse button")
 		lastCoord = inputs.getCoordinates()
+		graphMove = getGraphMove(inputs, len(history.getScoreSeq()))
 		if event.button.button == SDL_BUTTON_LEFT:
-			if lastCoord != None:
+			if graphMove != None:
+				srender = True
+				history.setBoard(board, current=True) # save current board
+				board = history.seekMove(graphMove)
+				ltime = time.time() + 1e6
+			elif lastCoord != None:
 				i, j = lastCoord
 				history.setBoard(board, current=True) # save current board
 				try:
@@ -741,10 +1307,110 @@ def autoplay(history):
 	if t - ltime < kttime: return None
 
 	pv = history.getPV(current=True)
-	visits, winrate, scoreMean, scoreStDev, moves = pv[0]
-	bestmove = moves[0]
+	if len(pv) == 0: return None
+	bestmove = divmod(int(pv["move"][0]), 19)
 	return bestmove 
 
+# The logic thread treats the events and describes the frames: the main 
+# thread owns the window and the renderer, as SDL requires, and only pumps
+# the events and draws. Events are forwarded to the logic thread, which
+# builds a scene (see build_scene) once per batch of events and publishes
+# it with an SDL_SCENE event. The main thread draws the latest published
+# scene, at most once per frame period: scenes replaced before being drawn
+# are skipped, and a slow frame never delays the treatment of inputs.
+class LogicThread(threading.Thread):
+
+	# - board, kata, history, inputs - as given to treatInput
+	# - sceneEvent - SDL event pushed when a scene is published
+	def __init__(self, board, kata, history, inputs, sceneEvent):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.board = board
+		self.kata = kata
+		self.history = history
+		self.inputs = inputs
+		self.sceneEvent = sceneEvent
+		self.events = queue.Queue()
+		self.lock = threading.Lock()
+		self.scene = None
+		self.stopped = False
+
+	# Forward an event. It is copied, as SDL reuses the event structure.
+	def post(self, event):
+		copy = SDL_Event()
+		ctypes.memmove(ctypes.byref(copy), ctypes.byref(event),
+			ctypes.sizeof(SDL_Event))
+		self.events.put(copy)
+
+	# Return the latest published scene, or None if it was already taken
+	def take(self):
+		with self.lock:
+			scene, self.scene = self.scene, None
+		return scene
+
+	def publish(self, scene):
+		with self.lock:
+			self.scene = scene
+		ev = SDL_Event()
+		ev.type = self.sceneEvent
+		SDL_PushEvent(ev)
+
+	# An exception ends the thread, and the application, with its traceback
+	def run(self):
+		try:
+			self.loop()
+		except Exception:
+			traceback.print_exc()
+		finally:
+			# Wake the main thread up, so that it notices the end
+			self.stopped = True
+			self.publish(None)
+
+	def loop(self):
+		board, kata, history = self.board, self.kata, self.history
+		self.publish(build_scene(board, history))
+		srun = True
+		while srun:
+			# Treat all the queued events, and describe the frame once for 
+			# all of them
+			events = [self.events.get()]
+			while not self.events.empty(): events.append(self.events.get())
+			srender = False
+			treated = {}
+			for event in events:
+				if isTreated(event, kata, treated): continue
+				srun, sevent = treatInput(event, board, kata, history,
+					self.inputs)
+				srender = srender or sevent
+				board = history.getCurrentBoard()
+				if not srun: break
+
+			if srun and srender:
+				self.publish(build_scene(board, history,
+					self.inputs.getCoordinates()))
+
+# KataGo events all refer to its last output. Return True if the output of
+# a KataGo event was already treated, and record it otherwise.
+# - treated - outputs treated, by event code
+def isTreated(event, kata, treated):
+	if event.type != SDL_KATAGO: return False
+	if event.user.code == KataGo.RAWNN_EVENT: output = kata.lastRawNN
+	else: output = kata.lastAnalyse
+	if output is None: return False
+	if treated.get(event.user.code) is output: return True
+	treated[event.user.code] = output
+	return False
+
+# Return the frame rate cap: MAX_FPS, or the refresh rate of the display
+# showing the window
+def getMaxFps(window):
+	if MAX_FPS: return MAX_FPS
+	mode = SDL_DisplayMode()
+	if SDL_GetWindowDisplayMode(window, ctypes.byref(mode)) == 0 \
+		and mode.refresh_rate > 0:
+		return mode.refresh_rate
+	return DEFAULT_FPS
+
 # Main function
 # run the katago-analyzer app.
 
@@ -759,6 +1425,17 @@ def run():
 	auto = args.play
 	kttime = args.kttime
 
+	if args.parseprocess:
+		KataGo.PARSE_PROCESS = True
+	if args.daemon:
+		KataGo.DAEMON = args.daemon
+	if args.smoothheat:
+		global SMOOTH_HEAT_MAP
+		SMOOTH_HEAT_MAP = True
+	if args.maxfps:
+		global MAX_FPS
+		MAX_FPS = args.maxfps
+
 	if auto:
 		print("KataGo playing {} thinking {} seconds".format(auto, kttime))
 		global ltime
@@ -797,34 +1474,52 @@ def run():
 
 	SDL_SetHint(SDL_HINT_RENDER_SCALE_QUALITY, b'1')
 
-	# Creating SDL_Events for Katago
+	# Creating SDL_Events for Katago, and for the scenes of the logic thread
 	SDL_KATAGO = SDL_RegisterEvents(1)
+	SDL_SCENE = SDL_RegisterEvents(1)
 
 	# Initialise board & katago & inputs
 	board, kata, history = init(SDL_KATAGO, path, skatago)
 	inputs = Inputs()
 
+	logic = LogicThread(board, kata, history, inputs, SDL_SCENE)
+	logic.start()
+
 	event = SDL_Event()	
-	render(board, history)
-	t = None
-	while True:
-		if t != None:
-			dt = time.time() - t
-			fps = 1 / dt
-			# print("FPS:", fps)
-		# Event loop
-		SDL_WaitEvent(event)
-		t = time.time()
-		srun, srender = treatInput(event, board, kata, history, inputs)
-		if not srun: break
-		if srender:
+	period = 1 / getMaxFps(window)
+	rtime = 0
+	scene = None
+	while not logic.stopped:
+		# Event loop - sleep until an event comes, or until the next frame if
+		# a scene is waiting
+		if scene != None:
+			delay = rtime + period - time.time()
+			pending = SDL_WaitEventTimeout(event, max(int(delay * 1000), 0))
+		else:
+			pending = SDL_WaitEvent(event)
+
+		while pending:
+			if event.type == SDL_SCENE:
+				scene = logic.take() or scene
+			else:
+				# Render targets lost - the pre-rendered textures belong to
+				# this thread
+				if event.type == SDL_RENDER_TARGETS_RESET: resetTargets()
+				logic.post(event)
+			pending = SDL_PollEvent(event)
+
+		if scene != None and not logic.stopped and \
+			time.time() >= rtime + period:
 			if DEBUG: print("########### Rendering !")
-			board = history.getCurrentBoard()
-			render(board, history, inputs.getCoordinates())
+			rtime = time.time()
+			draw_scene(scene)
+			kata.setRenderTime(time.time() - rtime)
+			scene = None
 
 	print("Closing KataGo")
 	kata.close()
 	print("Katago closed, closing everything else")
+	destroyTextures()
 	SDL_DestroyRenderer(renderer)
 	SDL_DestroyWindow(window)
 	destroyStoneTexture("black")
@@ -0,0 +1,140 @@
+import os
+import sys
+import numpy as np
+from multiprocessing import get_context, shared_memory, reduction
+
+from infos import Infos, INFO_DTYPE
+
+# Number of slots of the ring. KataGo sends at most a few analyses per
+# second, so the reader is rarely more than a couple of slots late. Slots
+# it did not read in time are overwritten, and the reader drops them (see
+# AnalysisRing.read).
+SLOTS = 16
+# Maximum number of infos (candidate moves) kept per analysis - every move
+# of a 19x19 board, and pass
+MAXINFOS = 362
+# Maximum length of a principal variation (see analysisPVLen in KataGo)
+MAXPV = 99
+
+SLOT_DTYPE = np.dtype([("seq", "u8"), ("ninfos", "i4"), ("ownership", "f4", (361,)),
+	("infos", INFO_DTYPE, (MAXINFOS,)), ("offsets", "u4", (MAXINFOS + 1,)),
+	("moves", "u2", (MAXINFOS * MAXPV,))])
+
+def sendFd(conn, fd, pid):
+	"""Send a file descriptor to the process 'pid' through a connection"""
+	if sys.platform == "win32":
+		import msvcrt
+		fd = msvcrt.get_osfhandle(fd)
+	reduction.send_handle(conn, fd, pid)
+
+def recvFd(conn):
+	"""Receive a file descriptor sent by sendFd()"""
+	fd = reduction.recv_handle(conn)
+	if sys.platform == "win32":
+		import msvcrt
+		fd = msvcrt.open_osfhandle(fd, os.O_RDONLY)
+	return fd
+
+def parseWorker(ring, conn, parse):
+	"""Body of the parser process.
+
+	Receive the file descriptor of KataGo's output through 'conn', read it,
+	parse each line with 'parse' and write analyses into 'ring'. For each 
+	line, the slot index and the sequence number of the analysis are sent 
+	through 'conn', or the line itself if it was not an analysis."""
+	out = os.fdopen(recvFd(conn), "rb")
+	count = 0
+	for line in iter(out.readline, b''):
+		line = line.decode()
+		analyse = parse(line)
+		if analyse == None:
+			conn.send(line)
+			continue
+		slot = count % SLOTS
+		conn.send((slot, ring.write(slot, *analyse)))
+		count += 1
+	out.close()
+	conn.close()
+
+class AnalysisRing:
+
+	"""Ring buffer of analyses in shared memory.
+
+	Each slot holds the ownership as a float32 slab and the arrays of an
+	infos.Infos object. The parser process writes slots and the reader 
+	thread reads them. The ring is pickled by the name of its shared
+	memory, which the parser process maps again.
+
+	Each slot has a sequence number, odd while the slot is being written.
+	The reader checks it before and after copying the slot, so that an
+	analysis overwritten by a writer lapping the ring is detected and
+	dropped instead of being read half-written."""
+
+	def __init__(self):
+		self.shm = shared_memory.SharedMemory(create=True,
+			size=SLOTS * SLOT_DTYPE.itemsize)
+		self.slots = np.ndarray((SLOTS,), dtype=SLOT_DTYPE, buffer=self.shm.buf)
+
+	def __getstate__(self):
+		return self.shm.name
+
+	def __setstate__(self, name):
+		self.shm = shared_memory.SharedMemory(name=name)
+		self.slots = np.ndarray((SLOTS,), dtype=SLOT_DTYPE, buffer=self.shm.buf)
+
+	def write(self, slot, infos, heatInfos):
+		"""Write an analysis, as returned by katago.parseLine(), in a slot.
+		Return the sequence number of the slot once written."""
+		rec = self.slots[slot]
+		rec["seq"] += 1
+		n = min(len(infos), MAXINFOS)
+		while infos.offsets[n] > MAXINFOS * MAXPV: n -= 1
+		if n < len(infos):
+			print("Analysis truncated to {} of its {} moves".format(n,
+				len(infos)))
+		offsets = infos.offsets[:n+1]
+		rec["ninfos"] = n
+		rec["ownership"][:] = heatInfos
+		rec["infos"][:n] = infos.rows[:n]
+		rec["offsets"][:n+1] = offsets
+		rec["moves"][:offsets[-1]] = infos.moves[:offsets[-1]]
+		rec["seq"] += 1
+		return int(rec["seq"])
+
+	def read(self, msg):
+		"""Return a copy of the analysis stored in a slot, in the
+		katago.parseLine() format - or None if it was overwritten meanwhile.
+		- msg - (slot, sequence number), as sent by parseWorker()"""
+		slot, seq = msg
+		rec = self.slots[slot]
+		if rec["seq"] != seq: return None
+		n = min(int(rec["ninfos"]), MAXINFOS)
+		offsets = rec["offsets"][:n+1].copy()
+		end = min(int(offsets[-1]), MAXINFOS * MAXPV)
+		infos = Infos(rec["infos"][:n].copy(), rec["moves"][:end].copy(),
+			offsets)
+		heatInfos = rec["ownership"].copy()
+		if rec["seq"] != seq: return None
+		return infos, heatInfos
+
+	def start(self, fd, parse):
+		"""Start a parser process reading the file descriptor 'fd'.
+		Return the connection the slot indices are received from.
+
+		The process is spawned rather than forked: it is started from the
+		reader thread on restarts, and a fork would inherit the locks held
+		by the other threads. 'fd' is then sent through the connection."""
+		ctx = get_context("spawn")
+		conn, child = ctx.Pipe()
+		proc = ctx.Process(target=parseWorker, args=(self, child, parse))
+		proc.daemon = True
+		proc.start()
+		child.close()
+		sendFd(conn, fd, proc.pid)
+		return conn
+
+	def close(self):
+		"""Release the shared memory"""
+		self.slots = None
+		self.shm.close()
+		self.shm.unlink()
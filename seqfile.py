@@ -0,0 +1,132 @@
+import os
+import mmap
+import numpy as np
+from collections import OrderedDict
+from threading import Thread, Lock
+
+from board import *
+from katago import parseLine
+
+# Number of decoded sequences kept in memory
+CACHE = 16
+# Size of the chunks scanned when indexing a file, in bytes
+CHUNK = 1 << 24
+
+def decodeSeq(txt, format="std"):
+	"""Decode a sequence written by Node.getSeqToCurrent(). Return the list
+	of moves (pla, i, j) and the analysis, as returned by parseLine() - or
+	None if there is no analysis."""
+	if format != "std":
+		raise Exception("Please finish implementation of decodeSeq")
+	txt = txt.split("@")
+	extrainfos = txt[1] if len(txt) > 1 else ""
+	moves = []
+	for movtxt in txt[0].split(";"):
+		if movtxt == "": break
+		c, mov = movtxt.split(".")
+		c = Board.BLACK if c == "B" else Board.WHITE
+		moves.append((c, *stdToCoord(mov)))
+	return moves, parseLine(extrainfos)
+
+def encodeSeq(moves, format="std"):
+	"""Encode a list of moves (pla, i, j) as ([pla].[move];)* - see 
+	Node.getSeqToCurrent() for the formats"""
+	txt = []
+	for pla, i, j in moves:
+		if format == "coord": 
+			txt.append("{}.({},{});".format(pla, i, j))
+		if format == "std":
+			c = "B" if pla == Board.BLACK else "W"
+			txt.append("{}.{};".format(c, coordToStd(i, j)))
+	return "".join(txt)
+
+def encodeInfos(infos, heatInfos):
+	"""Encode an analysis so that it can be parsed by parseLine()
+	- infos - an infos.Infos object
+	- heatInfos - the ownership, as a flat array"""
+	txt = []
+	for k, (visits, winrate, scoreMean, scoreStdev, moves) in enumerate(infos):
+		txt.append("info {} visits {} winrate {} scoreMean {} scoreStdev {} "
+			"prior {} lcb {} order {} pv {}".format(coordToStd(*moves[0]),
+			visits, winrate, scoreMean, scoreStdev, infos["prior"][k],
+			infos["lcb"][k], infos["order"][k],
+			" ".join(coordToStd(i, j) for i, j in moves)))
+	txt.append("ownership")
+	txt.append(" ".join(str(float(v)) for v in heatInfos))
+	return " ".join(txt) + " "
+
+class SeqFile:
+
+	"""File of sequences, one per line, as written by the 'g' key.
+
+	The file is mapped in memory and indexed once by line offsets, so that
+	opening it costs a single scan and memory stays flat whatever its size.
+	Sequences are decoded on demand (see decodeSeq()) and the last ones are
+	cached. prefetch() decodes the neighbours of a sequence in background,
+	so that browsing the file is instant."""
+
+	def __init__(self, path):
+		self.file = open(path, "rb")
+		size = os.fstat(self.file.fileno()).st_size
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) \
+			if size > 0 else b""
+		self.starts, self.ends = self._index(size)
+		self.lock = Lock()
+		self.cache = OrderedDict()
+		self.prefetching = []
+		self.closed = False
+
+	def _index(self, size):
+		"""Return the start and end offsets of the non-empty lines"""
+		newlines = [np.zeros(0, dtype="int64")]
+		for offset in range(0, size, CHUNK):
+			count = min(CHUNK, size - offset)
+			chunk = np.frombuffer(self.map, dtype="uint8", count=count,
+				offset=offset)
+			newlines.append(np.flatnonzero(chunk == ord("\n")) + offset)
+		newlines = np.concatenate(newlines)
+		starts = np.concatenate(([0], newlines + 1))
+		ends = np.append(newlines, size)
+		nonempty = ends > starts
+		return starts[nonempty], ends[nonempty]
+
+	def __len__(self):
+		return len(self.starts)
+
+	def __getitem__(self, k):
+		"""Return the k-th sequence, decoded by decodeSeq()"""
+		with self.lock:
+			if k in self.cache:
+				self.cache.move_to_end(k)
+				return self.cache[k]
+		txt = self.map[self.starts[k]:self.ends[k]].decode()
+		seq = decodeSeq(txt)
+		with self.lock:
+			self.cache[k] = seq
+			if len(self.cache) > CACHE: self.cache.popitem(last=False)
+		return seq
+
+	def prefetch(self, k):
+		"""Decode the sequences around the k-th one in background. Decoding
+		errors are ignored: they are reported when the sequence is loaded."""
+		def decode():
+			for n in (k + 1, k - 1):
+				if self.closed: break
+				try:
+					if 0 <= n < len(self): self[n]
+				except Exception:
+					pass
+		self.prefetching = [t for t in self.prefetching if t.is_alive()]
+		thread = Thread(target=decode)
+		thread.daemon = True
+		thread.start()
+		self.prefetching.append(thread)
+
+	def close(self):
+		"""Wait for the prefetching threads, which read the mapped file, then
+		unmap and close it"""
+		self.closed = True
+		for thread in self.prefetching: thread.join()
+		self.prefetching = []
+		if isinstance(self.map, mmap.mmap): self.map.close()
+		self.file.close()
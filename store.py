@@ -0,0 +1,150 @@
+import os
+import pickle
+import tempfile
+import numpy as np
+from collections import OrderedDict
+
+from infos import Infos
+
+# Memory budget of the packed analyses, in MB. Least recently used analyses
+# are spilled to disk beyond it.
+BUDGET = 256
+# Directory of the spill file - None for the system's temporary directory
+SPILL_DIR = None
+# Number of analyses kept unpacked, ready to be used
+HOT = 64
+
+EMPTY = Infos(), None, None
+
+def pack(pv, heat, rawnn):
+	"""Pack an analysis record into compact arrays: the infos.Infos arrays
+	for the pv, float16 for the heat, the policy and the ownership. A pv 
+	given as a list of tuples is converted."""
+	if not isinstance(pv, Infos): pv = Infos.fromList(pv)
+	if heat is not None: heat = np.asarray(heat, dtype="float16")
+	if rawnn is not None:
+		whiteWin, whiteLead, policy, ownership = rawnn
+		rawnn = whiteWin, whiteLead, np.asarray(policy, dtype="float16"), \
+			np.asarray(ownership, dtype="float16")
+	return pv, heat, rawnn
+
+def unpack(record):
+	"""Inverse of pack()"""
+	pv, heat, rawnn = record
+	if heat is not None: heat = heat.astype(float)
+	if rawnn is not None:
+		whiteWin, whiteLead, policy, ownership = rawnn
+		rawnn = whiteWin, whiteLead, policy.astype(float), \
+			ownership.astype(float)
+	return pv, heat, rawnn
+
+def packedSize(record):
+	"""Return the memory used by the arrays of a packed record, in bytes"""
+	pv, heat, rawnn = record
+	size = pv.nbytes
+	if heat is not None: size += heat.nbytes
+	if rawnn is not None: size += rawnn[2].nbytes + rawnn[3].nbytes
+	return size
+
+class AnalysisStore:
+
+	"""Memory-bounded storage of analysis records (pv, heat, raw network
+	evaluation), indexed by slot.
+
+	Records are kept packed in memory (see pack()), in least recently used
+	order. When they use more than the budget, the coldest ones are written
+	to a spill file and transparently reloaded when they are accessed. The
+	last used records are also kept unpacked, so that reading the analysis
+	of the current node costs nothing."""
+
+	def __init__(self, budget=None, spillDir=None):
+		"""
+		- budget - memory budget in MB, BUDGET if not set
+		- spillDir - directory of the spill file, SPILL_DIR if not set"""
+		self.budget = (BUDGET if budget == None else budget) * 2**20
+		self.spillDir = SPILL_DIR if spillDir == None else spillDir
+		self.packed = OrderedDict()
+		self.hot = OrderedDict()
+		self.size = 0
+		# slot -> (offset, length) of its record in the spill file. Kept while
+		# the record does not change, so that it is not written again.
+		self.spilled = {}
+		self.file = None
+
+	def get(self, slot):
+		"""Return the record (pv, heat, rawnn) of a slot. Empty records have
+		an empty pv and no heat nor rawnn."""
+		if slot in self.hot:
+			self.hot.move_to_end(slot)
+			return self.hot[slot]
+		if slot in self.packed:
+			self.packed.move_to_end(slot)
+			record = self.packed[slot]
+		elif slot in self.spilled:
+			record = self._load(slot)
+		else:
+			return EMPTY
+		return self._heat(slot, unpack(record))
+
+	def put(self, slot, pv, heat, rawnn):
+		"""Store the record of a slot"""
+		self.discard(slot)
+		if len(pv) == 0 and heat is None and rawnn is None: return None
+		record = pack(pv, heat, rawnn)
+		self.packed[slot] = record
+		self.size += packedSize(record)
+		self._heat(slot, (record[0], heat, rawnn))
+		self._evict()
+
+	def update(self, slot, **fields):
+		"""Change some fields (pv, heat or rawnn) of the record of a slot"""
+		pv, heat, rawnn = self.get(slot)
+		self.put(slot, fields.get("pv", pv), fields.get("heat", heat),
+			fields.get("rawnn", rawnn))
+
+	def discard(self, slot):
+		"""Forget the record of a slot. Its space in the spill file is not
+		reclaimed."""
+		self.hot.pop(slot, None)
+		self.spilled.pop(slot, None)
+		if slot in self.packed:
+			self.size -= packedSize(self.packed.pop(slot))
+
+	def _heat(self, slot, record):
+		"""Keep an unpacked record among the hot ones and return it"""
+		self.hot[slot] = record
+		if len(self.hot) > HOT: self.hot.popitem(last=False)
+		return record
+
+	def _evict(self):
+		"""Spill the least recently used records until the budget is met"""
+		while self.size > self.budget and len(self.packed) > 1:
+			slot, record = self.packed.popitem(last=False)
+			self.size -= packedSize(record)
+			self.hot.pop(slot, None)
+			if slot not in self.spilled: self._dump(slot, record)
+
+	def _dump(self, slot, record):
+		"""Append a packed record to the spill file"""
+		if self.file == None:
+			self.file = tempfile.TemporaryFile(dir=self.spillDir)
+		data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+		self.file.seek(0, os.SEEK_END)
+		self.spilled[slot] = self.file.tell(), len(data)
+		self.file.write(data)
+
+	def _load(self, slot):
+		"""Read back a spilled record and put it in memory again"""
+		offset, length = self.spilled[slot]
+		self.file.seek(offset)
+		record = pickle.loads(self.file.read(length))
+		self.packed[slot] = record
+		self.size += packedSize(record)
+		self._evict()
+		return record
+
+	def close(self):
+		"""Delete the spill file"""
+		if self.file != None: self.file.close()
+		self.file = None
+		self.spilled = {}